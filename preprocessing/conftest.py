@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from xmlrpc.server import SimpleXMLRPCServer
+
+import pytest
+from aiohttp_xmlrpc.client import ServerProxy
+
+
+class StubMoses:
+    """A stand-in for a Moses server. Echoes the text back as the translation and records the calls."""
+
+    def __init__(self, delay=0.0, port=0):
+        self.delay = delay
+        self.calls = []
+        self.server = SimpleXMLRPCServer(('127.0.0.1', port), logRequests=False, allow_none=True)
+        self.server.register_function(self.translate, 'translate')
+        self.server.register_multicall_functions()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/RPC2'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def translate(self, params):
+        self.calls.append(params['text'])
+        time.sleep(self.delay)
+        return {'text': params['text']}
+
+
+class PinnedServerProxy(ServerProxy):
+    """
+    Dispatches like the ServerProxy of the pinned aiohttp-xmlrpc 0.8.1: an attribute is a plain method, so nested names
+    like proxy.system.listMethods do not work, only getattr(proxy, 'system.listMethods').
+    """
+
+    def __getattr__(self, method_name):
+        method = super().__getattr__(method_name)
+        return lambda *args, **kwargs: method(*args, **kwargs)
+
+
+@pytest.fixture
+def start_moses():
+    """Starts StubMoses servers, e.g. replicas of a model, which are stopped after the test."""
+    stubs = []
+
+    def start(**kwargs) -> StubMoses:
+        stub = StubMoses(**kwargs)
+        stub.thread.start()
+        stubs.append(stub)
+        return stub
+
+    yield start
+    for stub in stubs:
+        stub.stop()
+
+
+@pytest.fixture
+def moses_server(start_moses):
+    return start_moses()
+
+
+@pytest.fixture
+def truecase_model(tmp_path):
+    path = tmp_path / 'truecase-model'
+    path.write_text('this (5/6) This (1)\nis (3/3)\nHaukur (2/2)\n')
+    return str(path)
+
+
+class StubEnrichment:
+    """
+    A stand-in for the Icelandic enrichment service. Tags each word as "x" with its lowercase form as the lemma.
+    The first failures requests fail with a 503. Records the texts of the requests and the most requests in flight.
+    """
+
+    def __init__(self, failures=0, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.texts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    failed = stub.failures > 0
+                    stub.failures -= 1 if failed else 0
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.in_flight -= 1
+                if failed:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                text = data['text'][0]
+                stub.texts.append(text)
+                paragraphs = [{'sentences': [[{'word': word, 'tag': 'x', 'lemma': word.lower()} for word in line.split()]]}
+                              for line in text.splitlines()]
+                body = json.dumps({'paragraphs': paragraphs}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def enrichment_server():
+    stub = StubEnrichment()
+    stub.thread.start()
+    yield stub
+    stub.stop()
@@ -1,14 +1,24 @@
 #!/usr/bin/env python
+import json
 import logging
 from glob import glob
+import itertools
 import pathlib
 
 import click
 
 from preprocessing import file_handler
 from preprocessing import pipeline
+from preprocessing import api as p_api
 from preprocessing import server as p_server
+from preprocessing import async_server
 from preprocessing import client
+from preprocessing import known_tokens as p_known_tokens
+from preprocessing import dedup as p_dedup
+from preprocessing import vocabulary as p_vocabulary
+from preprocessing import checkpoint as p_checkpoint
+from preprocessing import stage_cache as p_stage_cache
+from preprocessing import enrichment as p_enrichment
 
 log = logging.getLogger()
 
@@ -31,16 +41,26 @@ def write_factor(input, lang, save_to, lemma, pos, form, lines, threads, chunksi
 
 @click.command()
 @click.argument('input', type=click.File('r'))
-@click.argument('output', type=click.File('w+'))
+@click.argument('output', type=str)
 @click.argument('lang', type=str)
 @click.option('--tokenizer', type=str, default=None)
 @click.option('--truecase_model', type=str, default=None)
 @click.option('--known_tokens', type=str, default=None)
 @click.option('--threads', type=int, default=1)
-@click.option('--batch_size', type=int, default=5000000)
 @click.option('--chunksize', type=int, default=10000)
-def preprocess(input, output, lang, tokenizer, truecase_model, known_tokens, threads, batch_size, chunksize):
+@click.option('--use_kvistur', is_flag=True, help='Split unknown Icelandic compounds with Kvistur, requires --known_tokens.')
+@click.option('--kvistur_cache', type=str, default=None, help='A file to load the compound splits from and save them to.')
+@click.option('--pretokenized', is_flag=True, help='The input is the output of tokenize (with the same --tokenizer) and is not tokenized again.')
+@click.option('--resume', is_flag=True, help='Continue from the checkpoint of the output, if there is one.')
+@click.option('--checkpoint_interval', type=float, default=60.0, help='The minimum number of seconds between checkpoints.')
+def preprocess(input, output, lang, tokenizer, truecase_model, known_tokens, threads, chunksize, use_kvistur, kvistur_cache, pretokenized, resume,
+               checkpoint_interval):
+    """
+    Preprocesses the input. The output is checkpointed to OUTPUT.checkpoint, see --resume.
+    """
     log.info('Preprocessing')
+    params = dict(command='preprocess', input=input.name, lang=lang, tokenizer=tokenizer, truecase_model=truecase_model,
+                  known_tokens=known_tokens, use_kvistur=use_kvistur, pretokenized=pretokenized)
     if truecase_model is None:
         path = pathlib.Path(__file__).resolve().parent.joinpath('preprocessing').joinpath('resources').joinpath(f'truecase-model.{lang}')
         if path.exists():
@@ -49,13 +69,15 @@ def preprocess(input, output, lang, tokenizer, truecase_model, known_tokens, thr
         else:
             raise ValueError(f'Unable to find default truecase_model, path={path}')
     if known_tokens is not None:
-        # The known tokens should be a token per line.
-        with open(known_tokens, 'r') as f_in:
-            known_tokens = set(line.strip() for line in f_in)
-            log.info(f'Found known tokens, len={len(known_tokens)}')
-
-    for line in pipeline.preprocess(input, lang=lang, tokenizer=tokenizer, truecase_model=truecase_model, known_tokens=known_tokens, threads=threads, batch_size=batch_size, chunksize=chunksize):
-        output.write(line + '\n')
+        # The known tokens should be a token per line or a token set, see build_token_set.
+        known_tokens = p_known_tokens.load_known_tokens(known_tokens)
+        log.info(f'Found known tokens, len={len(known_tokens)}')
+
+    with p_checkpoint.CheckpointedOutput(output, params, resume=resume, interval=checkpoint_interval) as f_out:
+        for line in pipeline.preprocess(itertools.islice(input, f_out.done, None), lang=lang, tokenizer=tokenizer, truecase_model=truecase_model,
+                                        known_tokens=known_tokens, threads=threads, chunksize=chunksize, use_kvistur=use_kvistur,
+                                        kvistur_cache=kvistur_cache, pretokenized=pretokenized):
+            f_out.write(line + '\n')
     log.info('Done!')
 
 
@@ -74,21 +96,49 @@ def postprocess(input, output, lang, tokenizer):
 @click.command()
 @click.argument('input', type=click.File('r'))
 @click.argument('output', type=click.File('w+'))
-def extract_known_tokens(input, output):
+@click.option('--threads', type=int, default=1)
+@click.option('--chunksize', type=int, default=10000, help="Number of lines counted by a process at a time.")
+@click.option('--min_count', type=int, default=1, help="Skip tokens which occur less often.")
+@click.option('--counts', is_flag=True, help="Write the count after each token, separated by a tab.")
+def extract_known_tokens(input, output, threads, chunksize, min_count, counts):
+    """
+    Writes the vocabulary of a tokenized corpus, the most frequent tokens first.
+    """
     log.info('Extracting known tokens')
-    for tok in pipeline.extract_known_tokens(input):
-        output.write(tok + '\n')
+    vocabulary = p_vocabulary.sorted_vocabulary(p_vocabulary.count_vocabulary(input, threads=threads, chunksize=chunksize), min_count=min_count)
+    p_vocabulary.write_vocabulary(vocabulary, output, with_counts=counts)
+    log.info(f'Done! Tokens={len(vocabulary)}')
+
+
+@click.command()
+@click.argument('input', type=click.File('r'))
+@click.argument('output', type=str)
+def build_token_set(input, output):
+    """
+    Builds a compact token set from a token per line file or a vocabulary, see extract-known-tokens.
+    The token set is memory-mapped when loaded, see --known_tokens.
+    """
+    log.info('Building token set')
+    p_known_tokens.write_token_set((token for token, _ in p_vocabulary.read_vocabulary(input)), output)
     log.info('Done!')
 
 
 @click.command()
 @click.argument('input', type=click.File('r'))
-@click.argument('known', type=click.File('r'))
+@click.argument('known', type=click.Path(exists=True, dir_okay=False))
 @click.argument('output', type=click.File('w+'))
-def unknown_tokens(input, known, output):
+@click.option('--threads', type=int, default=1)
+@click.option('--chunksize', type=int, default=10000, help="Number of lines counted by a process at a time.")
+@click.option('--counts', is_flag=True, help="Write the count after each token, separated by a tab.")
+def unknown_tokens(input, known, output, threads, chunksize, counts):
+    """
+    Writes the tokens of a tokenized corpus which are not known, the most frequent first.
+    The known tokens are a token set, see build-token-set, or a token per line file.
+    """
     log.info('Finding unknown tokens')
-    for unknown_token in set(tok for line in pipeline.unknown_tokens(input, set(tok.strip() for tok in known)) for tok in line):
-        output.write(unknown_token + '\n')
+    known_tokens = p_known_tokens.load_known_tokens(known)
+    unknown = p_vocabulary.count_unknown_tokens(input, known_tokens, threads=threads, chunksize=chunksize)
+    p_vocabulary.write_vocabulary(p_vocabulary.sorted_vocabulary(unknown), output, with_counts=counts)
     log.info('Done!')
 
 
@@ -104,12 +154,13 @@ def train_bpe(argument):
 @click.argument('save_to', type=str)
 @click.argument('lang', type=str)
 @click.option('--threads', type=int, default=1)
-def train_truecase(input, save_to, lang, threads):
+@click.option('--chunksize', type=int, default=10000, help="Number of lines counted by a process at a time.")
+def train_truecase(input, save_to, lang, threads, chunksize):
     """
     Trains Moses truecase model
     """
     log.info(f'Training truecase model, save_to={save_to}')
-    pipeline.train_truecase(input, save_to=save_to, threads=threads)
+    pipeline.train_truecase(input, save_to=save_to, threads=threads, chunksize=chunksize)
     log.info('Done!')
 
 
@@ -135,17 +186,40 @@ def detruecase(input, output):
 
 
 @click.command()
-@click.argument('input', type=click.File('r'))
+@click.argument('input', type=click.Path(exists=True, dir_okay=False))
 @click.argument('output_train', type=click.File('w+'))
 @click.argument('output_test', type=click.File('w+'))
 @click.option('--test_size', type=int, default=2000)
 @click.option('--shuffle/--no-shuffle', default=True)
 @click.option('--seed', type=int, default=42)
-def split(input, output_train, output_test, test_size, shuffle, seed):
+@click.option('--parallel_input', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="The other side of a parallel corpus, split on the same lines.")
+@click.option('--parallel_output_train', type=click.File('w+'), default=None)
+@click.option('--parallel_output_test', type=click.File('w+'), default=None)
+def split(input, output_train, output_test, test_size, shuffle, seed, parallel_input, parallel_output_train, parallel_output_test):
+    """
+    Splits the input to train and test sets. The input is read twice; to count the lines and to write them.
+    """
     log.info('Splitting')
-    train, test = pipeline.split([line for line in input], test_size=test_size, shuffle=shuffle, seed=seed)
-    output_train.writelines(train)
-    output_test.writelines(test)
+    inputs = [input]
+    outputs = [(output_train, output_test)]
+    if parallel_input is not None:
+        if parallel_output_train is None or parallel_output_test is None:
+            raise click.UsageError('--parallel_input needs --parallel_output_train and --parallel_output_test.')
+        inputs.append(parallel_input)
+        outputs.append((parallel_output_train, parallel_output_test))
+    line_counts = [file_handler.count_lines(path) for path in inputs]
+    if len(set(line_counts)) != 1:
+        raise click.UsageError(f'The parallel inputs are not aligned, lines={line_counts}')
+    test_lines = pipeline.choose_test_lines(line_counts[0], test_size=test_size, shuffle=shuffle, seed=seed)
+    corpora = [open(path) for path in inputs]
+    try:
+        for is_test, lines in pipeline.split_lines(corpora, test_lines):
+            for (f_train, f_test), line in zip(outputs, lines):
+                (f_test if is_test else f_train).write(line)
+    finally:
+        for corpus in corpora:
+            corpus.close()
     log.info('Done.')
 
 
@@ -155,26 +229,38 @@ def split(input, output_train, output_test, test_size, shuffle, seed):
 @click.argument('lang')
 @click.option('--chunksize', type=int, default=4000, help="Number of lines to process at once.")
 @click.option('--lines', type=int, default=0, help="For debugging, limit processing to x lines per corpus. 0 for all.")
-def enrich(input, output, lang, chunksize: int, lines: int):
-    # TODO: Fix if we ever want to try factored again.
-    # file_handler.write_json(output, [*pipeline.enrich(corpus, lang=lang, chunksize=chunksize, lines=lines)])
-    # log.info('Done.')
-    pass
+@click.option('--concurrency', type=int, default=p_enrichment.CONCURRENCY,
+              help="The maximum number of requests in flight for Icelandic, defaults to $ENRICHMENT_CONCURRENCY or 4.")
+@click.option('--cache', type=str, default=p_enrichment.CACHE_FILE,
+              help="Keep the enriched Icelandic sentences in this file between runs, defaults to $ENRICHMENT_CACHE.")
+def enrich(input, output, lang, chunksize: int, lines: int, concurrency: int, cache):
+    """
+    Enriches the input with POS tags and lemmas. Writes a JSON list of the forms, the POS tags and the lemmas per line.
+    """
+    for forms, poss, lemmas in pipeline.enrich(input, lang=lang, chunksize=chunksize, lines=lines, concurrency=concurrency, cache_path=cache):
+        output.write(json.dumps([forms, poss, lemmas], ensure_ascii=False) + '\n')
+    log.info('Done.')
 
 
 @click.command()
 @click.argument('input', type=click.File('r'))
-@click.argument('output', type=click.File('w+'))
+@click.argument('output', type=str)
 @click.argument('lang')
 @click.option('--tokenizer', type=str, default=None)
 @click.option('--model', type=str, default=None)
 @click.option('--threads', type=int, default=1)
-@click.option('--batch_size', type=int, default=5000000)
 @click.option('--chunksize', type=int, default=10000)
-def tokenize(input, output, lang, tokenizer, model, threads, batch_size, chunksize):
+@click.option('--resume', is_flag=True, help='Continue from the checkpoint of the output, if there is one.')
+@click.option('--checkpoint_interval', type=float, default=60.0, help='The minimum number of seconds between checkpoints.')
+def tokenize(input, output, lang, tokenizer, model, threads, chunksize, resume, checkpoint_interval):
+    """
+    Tokenizes the input. The output is checkpointed to OUTPUT.checkpoint, see --resume.
+    """
     log.info('Tokenizing')
-    for tokens in pipeline.tokenize(input, lang, tokenizer=tokenizer, model=model, threads=threads, batch_size=batch_size, chunksize=chunksize):
-        output.write(' '.join(tokens) + '\n')
+    params = dict(command='tokenize', input=input.name, lang=lang, tokenizer=tokenizer, model=model)
+    with p_checkpoint.CheckpointedOutput(output, params, resume=resume, interval=checkpoint_interval) as f_out:
+        for tokens in pipeline.tokenize(itertools.islice(input, f_out.done, None), lang, tokenizer=tokenizer, model=model, threads=threads, chunksize=chunksize):
+            f_out.write(' '.join(tokens) + '\n')
     log.info('Done.')
 
 
@@ -194,29 +280,45 @@ def detokenize(input, output, lang, tokenizer, model):
 @click.command()
 @click.argument('input', type=click.File('r'))
 @click.argument('output', type=click.File('w+'))
-def deduplicate(input, output):
-    known_sent = set()
+@click.option('--mode', type=click.Choice(p_dedup.MODES), default='fingerprint',
+              help="'exact' keeps the lines in memory, 'fingerprint' only their hashes and 'external' uses temporary files.")
+@click.option('--bits', type=click.Choice(['64', '128']), default='64', help="The size of the line fingerprints.")
+@click.option('--normalize', is_flag=True, help="Ignore case, punctuation and white-space when comparing lines.")
+@click.option('--tmp_dir', type=str, default=None, help="The directory for the temporary files of the external mode.")
+@click.option('--parallel_input', type=click.File('r'), default=None, help="The other side of a parallel corpus. Line pairs are deduplicated.")
+@click.option('--parallel_output', type=click.File('w+'), default=None, help="Where to write the other side of the parallel corpus.")
+def deduplicate(input, output, mode, bits, normalize, tmp_dir, parallel_input, parallel_output):
     log.info('Deduplicating')
-    for line in pipeline.deduplicate(input, known=known_sent):
-        output.write(line)
+    if (parallel_input is None) != (parallel_output is None):
+        raise click.UsageError('--parallel_input and --parallel_output need to be set together.')
+    corpora = [input] if parallel_input is None else [input, parallel_input]
+    outputs = [output] if parallel_output is None else [output, parallel_output]
+    for lines in p_dedup.deduplicate(corpora, mode=mode, bits=int(bits), normalized=normalize, tmp_dir=tmp_dir):
+        for f_out, line in zip(outputs, lines):
+            f_out.write(line)
     log.info('Done.')
 
 
 @click.command()
 @click.argument('dir')
-@click.argument('output', type=click.File('w+'))
+@click.argument('output', type=str)
 @click.option('--threads', type=int, default=1, help="Number of threads to use.")
-@click.option('--chunksize', type=int, default=400, help="Number of files to process per thread.")
+@click.option('--chunksize', type=int, default=1, help="Number of files to process per thread at a time, the largest files are read first.")
+@click.option('--resume', is_flag=True, help='Continue from the checkpoint of the output, if there is one.')
+@click.option('--checkpoint_interval', type=float, default=60.0, help='The minimum number of seconds between checkpoints.')
 # TODO: Change pipeline so we accept a list of files instead.
-def read_rmh(dir, output, threads, chunksize):
+def read_rmh(dir, output, threads, chunksize, resume, checkpoint_interval):
     """
     Reads a directory and globs all .xml files (removing hdr files) and extracts all texts. Tailored to RMH .tei format reading.
-    Writes the output to .json.
+    Writes the output to .json. The output is checkpointed to OUTPUT.checkpoint after whole files, see --resume.
     """
     files = [xml_file for xml_file in glob(f'{dir}/**/*.xml', recursive=True) if not (xml_file.endswith('rmh2Hdr.xml') or xml_file.endswith('rmh1Hdr.xml'))]
     log.info(f'Processing dir={dir}, files found={len(files)}')
-    for line in file_handler.rmh_2_corpus(files, threads=threads, chunksize=chunksize):
-        output.write(' '.join(line) + '\n')
+    # The files are read in a fixed order, so the processed files are the first files of that order.
+    params = dict(command='read-rmh', dir=dir, files=len(files))
+    with p_checkpoint.CheckpointedOutput(output, params, resume=resume, interval=checkpoint_interval) as f_out:
+        for sentences in file_handler.read_rmh_files(files, threads=threads, chunksize=chunksize, skip=f_out.done):
+            f_out.write(''.join(' '.join(line) + '\n' for line in sentences))
     log.info('Done.')
 
 
@@ -240,8 +342,42 @@ def translate(input, output, lang_from, lang_to, model, url, batch_size):
 
 @click.command()
 @click.option('--debug', is_flag=True)
-def server(debug: bool) -> None:
-    p_server.app.run(debug=debug, host='0.0.0.0')
+@click.option('--async', 'use_async', is_flag=True, help="Serve with the asynchronous aiohttp server instead of Flask.")
+@click.option('--port', type=int, default=5000)
+def server(debug: bool, use_async: bool, port: int) -> None:
+    if use_async:
+        from aiohttp import web
+        web.run_app(async_server.create_app(), host='0.0.0.0', port=port)
+    else:
+        p_api.handle_signals()
+        p_server.app.run(debug=debug, host='0.0.0.0', port=port)
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option('--output', 'outputs', multiple=True, required=True, help="A file written by the command, can be repeated.")
+@click.option('--depends', multiple=True, type=click.Path(exists=True), help="Another file read by the command, e.g. a default model. Can be repeated.")
+@click.option('--cache_dir', type=str, envvar='STAGE_CACHE_DIR', required=True, help="The cache directory, defaults to $STAGE_CACHE_DIR.")
+def stage(command, outputs, depends, cache_dir):
+    """
+    Runs a main.py COMMAND unless it has been run before with the same inputs, parameters and code. Then its outputs are
+    copied from the cache. The arguments which are files or directories are hashed as inputs, e.g.
+
+    ./main.py stage --output out.txt -- preprocess in.txt out.txt is --truecase_model model
+    """
+    cache = p_stage_cache.StageCache(cache_dir)
+    try:
+        key = cache.key(command, outputs, depends)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    manifest = cache.restore(key, outputs)
+    if manifest is not None:
+        log.info(f'Reused stage={" ".join(command)}, key={key}, created={manifest["created"]}')
+        return
+    log.info(f'Running stage={" ".join(command)}, key={key}')
+    cli.main(args=list(command), standalone_mode=False)
+    cache.store(key, outputs, command)
+    log.info(f'Cached stage={" ".join(command)}, key={key}')
 
 
 @click.group()
@@ -254,6 +390,7 @@ cli.add_command(train_truecase)
 cli.add_command(truecase)
 cli.add_command(detruecase)
 cli.add_command(extract_known_tokens)
+cli.add_command(build_token_set)
 cli.add_command(unknown_tokens)
 cli.add_command(split)
 cli.add_command(write_factor)
@@ -266,6 +403,7 @@ cli.add_command(postprocess)
 cli.add_command(server)
 cli.add_command(translate)
 cli.add_command(train_bpe)
+cli.add_command(stage)
 
 
 if __name__ == "__main__":
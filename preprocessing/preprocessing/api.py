@@ -3,17 +3,30 @@ The API for preprocessing and translating sentences.
 
 Supports multiple preprocessing version and multiple (Moses) translation endpoints.
 """
-from typing import List
+from typing import Any, List, Dict, Optional, Tuple, Callable, Union, Iterator, AsyncIterator, Awaitable
+from collections import OrderedDict
 import asyncio
+import atexit
+import json
+import math
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import os
 import logging
+import queue
+import signal
+import threading
 from time import time
 import pathlib
 
-from aiohttp import ClientTimeout
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
 from aiohttp_xmlrpc.client import ServerProxy
+from aiohttp_xmlrpc.exceptions import XMLRPCError
 
 from preprocessing import pipeline
+from preprocessing import known_tokens
+from preprocessing import metrics
 
 log = logging.getLogger('frontend.api')
 
@@ -22,6 +35,10 @@ MODELS = dict()
 Set using environment variables. To define a model "en-is-baseline" with endpoint "http://localhost:8080/RPC2" set:
 
 export MODEL_en_is_baseline=http://localhost:8080/RPC2
+
+A model can be served by multiple Moses replicas, separate the URLs with a comma:
+
+export MODEL_en_is_baseline=http://moses-1:8080/RPC2,http://moses-2:8080/RPC2
 """
 for key in os.environ:
     if "MODEL" in key:
@@ -51,21 +68,64 @@ We first load from the resources package; {'is':'path'}
 Additional models can be set via environment variables or overwritten. To define known tokens for "is" with path "/here/it/is" set:
 
 export TOKENS_is=/here/it/is
+
+A file built with "main.py build-token-set" is memory-mapped and shared by all processes, a plain token per line file is read into a set.
 """
 for lang in ['is', 'en']:
     path = pathlib.Path(os.path.realpath(__file__)).parent.joinpath('resources').joinpath(f'tok.{lang}')
     if path.exists():
-        with path.open() as f_in:
-            TOKENS[lang] = set(line.strip() for line in f_in)
+        TOKENS[lang] = known_tokens.load_known_tokens(str(path))
     else:
         TOKENS[lang] = set()
 for key in os.environ:
     if "TOKENS" in key:
-        path = pathlib.Path(os.environ.get(key))
-        with path.open() as f_in:
-            TOKENS[key.split('_')[1]] = set(line.strip() for line in f_in)
+        TOKENS[key.split('_')[1]] = known_tokens.load_known_tokens(os.environ.get(key))
 log.info(f'Defined known tokens: {(lang, len(TOKENS[lang])) for lang in TOKENS}')
 
+EXECUTOR = os.environ.get('PROCESSING_EXECUTOR', 'inline')
+"""Where the CPU-bound pre- and postprocessing runs; "inline" (on the event loop), "thread" or "process".
+With "process" the preprocessing of a bulk request runs on all cores while the Moses calls are in flight. To set:
+
+export PROCESSING_EXECUTOR=process
+"""
+WORKERS = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count() or 1))
+"""The number of workers used by the "thread" and "process" executors. Defaults to the number of cores."""
+log.info(f'Defined processing executor: {EXECUTOR}, workers={WORKERS}')
+
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 100000))
+"""The maximum number of translated sentences kept in the translation cache. 0 disables the cache."""
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 0))
+"""How long a cached translation is valid, in seconds. 0 for no expiry."""
+CACHE_FILE = os.environ.get('CACHE_FILE', None)
+"""If set, the translation cache is read from this file on startup and written to it on shutdown, see handle_signals(). To set:
+
+export CACHE_FILE=/data/translation-cache.json
+"""
+log.info(f'Defined translation cache: size={CACHE_SIZE}, ttl={CACHE_TTL}, file={CACHE_FILE}')
+
+REPLICA_MAX_FAILURES = int(os.environ.get('REPLICA_MAX_FAILURES', 3))
+"""A Moses replica is ejected after this many consecutive connection errors or timeouts."""
+REPLICA_PROBE_INTERVAL = float(os.environ.get('REPLICA_PROBE_INTERVAL', 5))
+"""How often ejected Moses replicas are probed, in seconds. A replica which responds is used again."""
+
+MOSES_BATCH_SIZE = int(os.environ.get('MOSES_BATCH_SIZE', 1))
+"""The maximum number of sentences sent to Moses in a single XMLRPC system.multicall. 1 disables batching.
+The sentences are collected from all concurrent requests for the same model. To set:
+
+export MOSES_BATCH_SIZE=32
+"""
+MOSES_BATCH_WINDOW = float(os.environ.get('MOSES_BATCH_WINDOW', 0.005))
+"""How long a batch waits for more sentences before it is sent, in seconds."""
+
+USE_KVISTUR = os.environ.get('USE_KVISTUR', '0').lower() in ('1', 'true')
+"""If set, unknown Icelandic tokens are split with Kvistur, which needs to be available on PYTHONPATH."""
+KVISTUR_CACHE_FILE = os.environ.get('KVISTUR_CACHE_FILE', None)
+"""If set, the compound split cache is read from this file on startup and written to it on shutdown.
+The splits found by process executor workers are merged into the cache of the server process, see TranslationEngine. To set:
+
+export KVISTUR_CACHE_FILE=/data/kvistur-cache.json
+"""
+
 
 def preprocess(sent: str, lang: str) -> str:
     """
@@ -75,12 +135,31 @@ def preprocess(sent: str, lang: str) -> str:
     :param lang: The language of the sentence.\n
     :return: The preprocessed sentence
     """
+    return preprocess_bulk([sent], lang)[0]
+
+
+def preprocess_bulk(sents: List[str], lang: str) -> List[str]:
+    """
+    Applies the necessary preprocessing steps to a batch of sentences before translation.
+
+    :param sents: The sentences to preprocess.\n
+    :param lang: The language of the sentences.\n
+    :return: The preprocessed sentences
+    """
     try:
         truecase_model = TRUECASERS[lang]
     except KeyError:
         raise ValueError(f'Truecase model not specified for lang={lang}')
     # TODO: Maybe we want to have some known tokens in production
-    return pipeline.preprocess_line(sent, lang=lang, truecase_model=truecase_model, known_tokens=TOKENS[lang], tokenizer="")
+    return pipeline.preprocess_lines(sents, lang=lang, truecase_model=truecase_model, known_tokens=TOKENS[lang], tokenizer="",
+                                     use_kvistur=USE_KVISTUR, kvistur_cache=KVISTUR_CACHE_FILE)
+
+
+def _preprocess_bulk_with_splits(sents: List[str], lang: str) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Runs preprocess_bulk() in an executor worker and returns the new compound splits of the worker along with the sentences.
+    """
+    return preprocess_bulk(sents, lang), pipeline.load_split_cache(KVISTUR_CACHE_FILE).delta()
 
 
 def postprocess(sent: str, lang: str) -> str:
@@ -94,44 +173,696 @@ def postprocess(sent: str, lang: str) -> str:
     return pipeline.postprocess([sent], lang=lang, tokenizer="")[0]
 
 
-def translate_bulk(sentences: List[str], s_lang: str, t_lang: str, model: str, id: str) -> List[str]:
+def preload() -> None:
     """
-    Preprocesses and translates the sentences from source language to target language.
-    Uses the endpoint defined by model and preprocessing steps for the model.
+    Loads the preprocessing models of all the languages, so the first request to a worker process is not slowed down.
+    """
+    for lang, truecase_model in TRUECASERS.items():
+        try:
+            pipeline.preload(lang, tokenizer="", truecase_model=truecase_model, use_kvistur=USE_KVISTUR, kvistur_cache=KVISTUR_CACHE_FILE)
+        except (OSError, ImportError) as error:
+            # A broken initializer breaks the whole pool, the requests for this language fail instead.
+            log.warning(f'Unable to preload lang={lang}: {error}')
+
+
+def make_executor(kind: str, workers: int) -> Optional[Executor]:
+    """
+    Creates the executor which runs the pre- and postprocessing.
+
+    :param kind: "inline", "thread" or "process".\n
+    :param workers: The number of workers.\n
+    :return: The executor, None for "inline".
+    """
+    if kind == 'inline':
+        return None
+    elif kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    elif kind == 'process':
+        # The server runs threads, so we do not fork it.
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=preload)
+    else:
+        raise ValueError(f'Unknown executor={kind}')
+
+
+async def run_in_executor(executor: Optional[Executor], f: Callable, *args):
+    """
+    Runs f(*args) in the executor and waits for the result. Runs f directly if there is no executor.
+    """
+    if executor is None:
+        return f(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, f, *args)
+
+
+CacheKey = Tuple[str, str, str]
+
+
+class TranslationCache:
+    """
+    An LRU cache of translated sentences with an optional time-to-live, keyed by (model, source language, sentence).
+    The source sentences are normalized by collapsing white-space.
+    """
+
+    def __init__(self, max_size: int, ttl: float = 0, path: Optional[str] = None):
+        """
+        :param max_size: The maximum number of cached sentences, the least recently used are evicted.\n
+        :param ttl: How long a cached translation is valid, in seconds. 0 for no expiry.\n
+        :param path: The file the cache is loaded from and saved to. None to keep the cache in memory only.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[CacheKey, Tuple[str, float]]' = OrderedDict()
+
+    @staticmethod
+    def key(model: str, lang: str, sent: str) -> CacheKey:
+        return model, lang, " ".join(sent.split())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        """
+        :return: The cached translation or None if it is not cached or has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl and time() - entry[1] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: CacheKey, translation: str, created: Optional[float] = None) -> None:
+        self._entries[key] = (translation, time() if created is None else created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        Writes the cached translations to a JSON file, oldest used first. The file is replaced atomically.
+        """
+        path = path or self.path
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f_out:
+            json.dump([[*key, translation, created] for key, (translation, created) in self._entries.items()], f_out, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        log.info(f'Saved translation cache={path}, size={len(self._entries)}')
+
+    def load(self, path: Optional[str] = None) -> None:
+        """
+        Reads cached translations written by save(), skipping the expired ones. Does nothing if the file does not exist.
+        """
+        path = path or self.path
+        if not os.path.exists(path):
+            return
+        with open(path) as f_in:
+            for model, lang, sent, translation, created in json.load(f_in):
+                if not self.ttl or time() - created <= self.ttl:
+                    self.put((model, lang, sent), translation, created=created)
+        log.info(f'Loaded translation cache={path}, size={len(self._entries)}')
+
+
+class Replica:
+    """A single Moses server of a model and its load and health."""
+
+    def __init__(self, url: str, session: ClientSession):
+        self.url = url
+        self.proxy = ServerProxy(url, client=session, encoding='utf-8')
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+
+    def __repr__(self):
+        return f'Replica(url={self.url}, outstanding={self.outstanding}, failures={self.failures}, healthy={self.healthy})'
+
+
+class ModelClient:
+    """
+    Sends the translation requests for a single model to Moses over a keep-alive connection pool.
+
+    A model can have multiple Moses replicas. Each call goes to the healthy replica with the fewest outstanding calls.
+    A replica is ejected after max_failures consecutive connection errors or timeouts and the call is retried on another one.
+    Ejected replicas are probed in the background and used again once they respond.
+
+    Requests for the same (preprocessed) sentence which are in flight at the same time share a single call to Moses.
+    With batch_size > 1 the sentences of concurrent requests are collected for up to batch_window seconds
+    and sent to Moses in a single XMLRPC system.multicall.
+    Has the same translate() method as the XMLRPC proxy. Needs to be created on the event loop which runs the engine.
+    """
+
+    def __init__(self,
+                 urls: str,
+                 timeout: ClientTimeout,
+                 connections: int,
+                 keepalive_timeout: float,
+                 max_failures=REPLICA_MAX_FAILURES,
+                 probe_interval=REPLICA_PROBE_INTERVAL,
+                 batch_size=MOSES_BATCH_SIZE,
+                 batch_window=MOSES_BATCH_WINDOW,
+                 model=''):
+        """
+        :param urls: The comma separated URLs of the Moses replicas.\n
+        :param timeout: The timeout of a single call to Moses.\n
+        :param connections: The maximum number of open connections.\n
+        :param keepalive_timeout: How long an idle connection is kept open, in seconds.\n
+        :param max_failures: The number of consecutive failures before a replica is ejected.\n
+        :param probe_interval: How often ejected replicas are probed, in seconds.\n
+        :param batch_size: The maximum number of sentences sent in a single call. 1 disables batching.\n
+        :param batch_window: How long a batch waits for more sentences, in seconds.\n
+        :param model: The name of the model, used in the metrics.
+        """
+        self.model = model
+        self.session = ClientSession(connector=TCPConnector(limit=connections, keepalive_timeout=keepalive_timeout), timeout=timeout)
+        self.replicas = [Replica(url.strip(), self.session) for url in urls.split(',') if url.strip() != '']
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._in_flight: Dict[str, asyncio.Future] = dict()
+        self._batch: List[Tuple[Dict[str, str], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._prober = asyncio.ensure_future(self._probe())
+
+    async def translate(self, params: Dict[str, str]) -> Dict[str, str]:
+        """
+        Translates params['text'], or waits for the identical translation which is already in flight.
+
+        :param params: The XMLRPC translation parameters.\n
+        :return: The XMLRPC translation result.
+        """
+        text = params['text']
+        future = self._in_flight.get(text)
+        if future is None:
+            future = asyncio.ensure_future(self._call(params))
+            self._in_flight[text] = future
+            future.add_done_callback(partial(self._done, text))
+        else:
+            log.debug(f"Coalesced translation of text={text}")
+        # A cancelled caller should not cancel the call for the others.
+        return await asyncio.shield(future)
+
+    def _done(self, text: str, future: asyncio.Future) -> None:
+        if self._in_flight.get(text) is future:
+            del self._in_flight[text]
+
+    def pick(self, exclude: List[Replica]) -> Optional[Replica]:
+        """
+        :param exclude: Replicas which should not be picked.\n
+        :return: The healthy replica with the fewest outstanding calls. If all are ejected, the least loaded of those.
+        """
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        healthy = [replica for replica in candidates if replica.healthy]
+        if len(healthy) != 0:
+            candidates = healthy
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda replica: replica.outstanding)
+
+    async def _call(self, params: Dict[str, str]) -> Dict[str, str]:
+        if self.batch_size <= 1:
+            return await self._route(lambda replica: replica.proxy.translate(params))
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((params, future))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if len(batch) != 0:
+            asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch: List[Tuple[Dict[str, str], asyncio.Future]]) -> None:
+        calls = [{'methodName': 'translate', 'params': [params]} for params, _ in batch]
+        try:
+            # getattr() works with the pinned aiohttp-xmlrpc 0.8, where proxy.system.multicall does not, see _probe().
+            results = await self._route(lambda replica: getattr(replica.proxy, 'system.multicall')(calls), weight=len(batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        log.debug(f"Sent batch of size={len(batch)}")
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            # A successful call returns a list with the result, a failed one a fault struct.
+            if isinstance(result, list):
+                future.set_result(result[0])
+            else:
+                future.set_exception(XMLRPCError(f"Moses fault: {result.get('faultString', result)}"))
+
+    async def _route(self, call: Callable[[Replica], Awaitable], weight=1):
+        """
+        Makes the call on the least loaded healthy replica, and retries it on the others on connection errors or timeouts.
+
+        :param call: Makes the XMLRPC call on the given replica.\n
+        :param weight: The number of sentences in the call.\n
+        :return: The result of the call.
+        """
+        tried: List[Replica] = []
+        while True:
+            replica = self.pick(exclude=tried)
+            if replica is None:
+                raise ValueError(f'No Moses replicas for model={self.model}')
+            tried.append(replica)
+            replica.outstanding += weight
+            metrics.MOSES_IN_FLIGHT.inc(model=self.model)
+            try:
+                result = await call(replica)
+                replica.failures = 0
+                return result
+            except (ClientError, OSError, asyncio.TimeoutError) as e:
+                replica.failures += 1
+                log.warning(f"Moses call failed, replica={replica}, error={e!r}")
+                if replica.healthy and replica.failures >= self.max_failures:
+                    replica.healthy = False
+                    log.warning(f"Ejected replica={replica}")
+                if len(tried) == len(self.replicas):
+                    raise
+            finally:
+                replica.outstanding -= weight
+                metrics.MOSES_IN_FLIGHT.dec(model=self.model)
+
+    async def _probe(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for replica in self.replicas:
+                if not replica.healthy:
+                    try:
+                        # The dotted name is looked up at once, attributes of the proxy are plain methods in aiohttp-xmlrpc 0.8.
+                        await asyncio.wait_for(getattr(replica.proxy, 'system.listMethods')(), timeout=self.probe_interval)
+                    except XMLRPCError:
+                        # A fault is still a response.
+                        pass
+                    except (ClientError, OSError, asyncio.TimeoutError):
+                        continue
+                    except Exception:
+                        # The prober should keep running, whatever the error.
+                        log.exception(f"Probing replica={replica} failed")
+                        continue
+                    replica.healthy = True
+                    replica.failures = 0
+                    log.info(f"Replica is back, replica={replica}")
+
+    async def close(self) -> None:
+        self._prober.cancel()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        for _, future in self._batch:
+            future.cancel()
+        await self.session.close()
+
+
+class TranslationEngine:
+    """
+    A long-lived translation engine, shared by all translation requests.
+
+    Holds a keep-alive connection pool (a ModelClient) per model in MODELS so consecutive requests reuse
+    the TCP connections to the Moses servers. The clients are created lazily on the event loop which runs the engine.
+    """
+
+    def __init__(self,
+                 models: Dict[str, str],
+                 executor: Optional[Executor] = None,
+                 cache: Optional[TranslationCache] = None,
+                 timeout=60,
+                 connections=100,
+                 keepalive_timeout=60,
+                 max_failures=REPLICA_MAX_FAILURES,
+                 probe_interval=REPLICA_PROBE_INTERVAL,
+                 batch_size=MOSES_BATCH_SIZE,
+                 batch_window=MOSES_BATCH_WINDOW,
+                 workers=1):
+        """
+        :param models: The accepted models and the (comma separated) URLs to their translation endpoints.\n
+        :param executor: Runs the pre- and postprocessing, see make_executor(). None to run them on the event loop.\n
+        :param cache: Holds previously translated sentences. None to disable caching.\n
+        :param timeout: The total timeout of a single call to Moses, in seconds.\n
+        :param connections: The maximum number of open connections per model.\n
+        :param keepalive_timeout: How long an idle connection is kept open, in seconds.\n
+        :param max_failures: The number of consecutive failures before a Moses replica is ejected.\n
+        :param probe_interval: How often ejected Moses replicas are probed, in seconds.\n
+        :param batch_size: The maximum number of sentences sent to Moses in a single call. 1 disables batching.\n
+        :param batch_window: How long a batch waits for more sentences, in seconds.\n
+        :param workers: The sentences of a request are preprocessed in this many batches, usually the number of executor workers.
+        """
+        self.models = models
+        self.executor = executor
+        self.cache = cache
+        self.timeout = ClientTimeout(total=timeout)
+        self.connections = connections
+        self.keepalive_timeout = keepalive_timeout
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.workers = workers
+        self._clients: Dict[str, ModelClient] = dict()
+
+    def get_client(self, model: str) -> ModelClient:
+        """
+        Returns the client for the model. Needs to be called from the event loop which runs the engine.
+
+        :param model: A string specifying the model.\n
+        :return: The client.
+        """
+        if model not in self._clients:
+            self._clients[model] = ModelClient(self.models[model], timeout=self.timeout, connections=self.connections,
+                                               keepalive_timeout=self.keepalive_timeout, max_failures=self.max_failures,
+                                               probe_interval=self.probe_interval, batch_size=self.batch_size,
+                                               batch_window=self.batch_window, model=model)
+        return self._clients[model]
+
+    async def translate_bulk(self, sentences: List[str], s_lang: str, t_lang: str, model: str, id: str, use_cache=True) -> List[str]:
+        """
+        Preprocesses and translates the sentences from source language to target language.
+        Uses the endpoint defined by model and preprocessing steps for the model.
+        Duplicate sentences are only translated once.
+
+        :param sentences: A list of sentences to translate.\n
+        :param s_lang: The source language.\n
+        :param t_lang: The target language.\n
+        :param model: A string specifying the model.\n
+        :param id: The UUID of the translation request.\n
+        :param use_cache: If False, the cached translations are not used. The new translations are still cached.\n
+        :return: The translated sentences.
+        """
+        translated: List[str] = []
+        client = self.get_client(model)
+        start = time()
+        metrics.SENTENCES.inc(len(sentences), model=model)
+        metrics.REQUESTS_IN_FLIGHT.inc(model=model)
+
+        try:
+            tasks = self._start(list(dict.fromkeys(sentences)), s_lang, t_lang, model, client, id, use_cache)
+            translations = dict(zip(tasks.keys(), await asyncio.gather(*tasks.values())))
+            translated = [translations[sentence] for sentence in sentences]
+        except asyncio.TimeoutError:
+            log.error(f"Translation timed-out id={id}")
+            metrics.TIMEOUTS.inc(model=model)
+        except Exception:
+            metrics.ERRORS.inc(model=model)
+            raise
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec(model=model)
+
+        end = time()
+        metrics.REQUEST_SECONDS.observe(end - start, model=model)
+        log.info(f"Bulk translation id={id}: took={end - start:.2f}, sentences={len(sentences)}, unique={len(set(sentences))}")
+        if self.cache is not None:
+            log.info(f"Translation cache: {self.cache.stats()}")
+        return translated
+
+    async def translate_stream(self,
+                               sentences: List[str],
+                               s_lang: str,
+                               t_lang: str,
+                               model: str,
+                               id: str,
+                               use_cache=True) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Like translate_bulk() but yields each translation with the index of its sentence as soon as it is ready.
+        A timed-out translation ends the stream with an asyncio.TimeoutError, so the caller can tell it from a complete stream.
+
+        :return: An iterator of (index, translated sentence), in the order the translations finish.
+        """
+        client = self.get_client(model)
+        start = time()
+        metrics.SENTENCES.inc(len(sentences), model=model)
+        metrics.REQUESTS_IN_FLIGHT.inc(model=model)
+        # Duplicate sentences are only translated once.
+        indices: Dict[str, List[int]] = dict()
+        for index, sentence in enumerate(sentences):
+            indices.setdefault(sentence, []).append(index)
+        tasks = {task: sentence for sentence, task in self._start(list(indices), s_lang, t_lang, model, client, id, use_cache).items()}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    translated = task.result()
+                    for index in indices[tasks[task]]:
+                        yield index, translated
+        except asyncio.TimeoutError:
+            log.error(f"Translation timed-out id={id}")
+            metrics.TIMEOUTS.inc(model=model)
+            raise
+        except Exception:
+            metrics.ERRORS.inc(model=model)
+            raise
+        finally:
+            # The consumer might have stopped early.
+            for task in pending:
+                task.cancel()
+            metrics.REQUESTS_IN_FLIGHT.dec(model=model)
+
+        end = time()
+        metrics.REQUEST_SECONDS.observe(end - start, model=model)
+        log.info(f"Streamed translation id={id}: took={end - start:.2f}, sentences={len(sentences)}, unique={len(indices)}")
+
+    def _start(self,
+               sentences: List[str],
+               s_lang: str,
+               t_lang: str,
+               model: str,
+               client: ModelClient,
+               id: str,
+               use_cache: bool) -> Dict[str, asyncio.Future]:
+        """
+        Starts translating the unique sentences. The sentences which are not cached are preprocessed in self.workers batches.
+        The translation of a sentence starts as soon as its batch is preprocessed.
+
+        :return: The sentences and their translations to be awaited.
+        """
+        translations: Dict[str, asyncio.Future] = dict()
+        missing = []
+        for sentence in sentences:
+            translated = None
+            if self.cache is not None and use_cache:
+                translated = self.cache.get(TranslationCache.key(model, s_lang, sentence))
+            if translated is not None:
+                log.info(f"Translation id={id}: cached={translated}")
+                translations[sentence] = asyncio.get_running_loop().create_future()
+                translations[sentence].set_result(translated)
+            else:
+                missing.append(sentence)
+        size = max(1, math.ceil(len(missing) / self.workers))
+        for batch_start in range(0, len(missing), size):
+            batch = missing[batch_start:batch_start + size]
+            preprocessed = asyncio.ensure_future(self._preprocess(batch, s_lang, model, id))
+            for position, sentence in enumerate(batch):
+                translations[sentence] = asyncio.ensure_future(self._translate(sentence, preprocessed, position, s_lang, t_lang, model,
+                                                                               client, id))
+        return translations
+
+    async def _preprocess(self, sentences: List[str], s_lang: str, model: str, id: str) -> List[str]:
+        log.info(f"Translation id={id}: preprocessing batch of size={len(sentences)}")
+        start = time()
+        preprocessed, delta = await run_in_executor(self.executor, _preprocess_bulk_with_splits, sentences, s_lang)
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # Threads share the cache of the server process, workers have their own.
+            pipeline.load_split_cache(KVISTUR_CACHE_FILE).merge(delta)
+        took = time() - start
+        for _ in sentences:
+            metrics.PREPROCESS_SECONDS.observe(took / len(sentences), model=model)
+        return preprocessed
+
+    async def _translate(self,
+                         sent: str,
+                         preprocessed: asyncio.Future,
+                         position: int,
+                         s_lang: str,
+                         t_lang: str,
+                         model: str,
+                         client: ModelClient,
+                         id: str) -> str:
+        # The batch is shared, a cancelled sentence should not cancel it.
+        sentence = (await asyncio.shield(preprocessed))[position]
+        translated = await translate_preprocessed(sentence, t_lang, client, id, self.executor, model=model)
+        if self.cache is not None:
+            self.cache.put(TranslationCache.key(model, s_lang, sent), translated)
+        return translated
+
+    async def close(self) -> None:
+        """
+        Closes all the open connections. Needs to be called from the event loop which runs the engine.
+        """
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.cache is not None and self.cache.path is not None:
+            self.cache.save()
+        if USE_KVISTUR and KVISTUR_CACHE_FILE is not None:
+            pipeline.load_split_cache(KVISTUR_CACHE_FILE).save()
+
+
+def describe_error(error: BaseException) -> str:
+    """
+    :return: A short description of a failed translation, e.g. for the final line of a translation stream.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return 'Translation timed out'
+    return f'{type(error).__name__}: {error}'
+
+
+def create_engine() -> TranslationEngine:
+    """
+    Creates a translation engine as configured by the environment variables, see MODELS, EXECUTOR and CACHE_SIZE.
+    The engine needs to be closed by the caller.
+
+    :return: The translation engine.
+    """
+    cache = None
+    if CACHE_SIZE > 0:
+        cache = TranslationCache(CACHE_SIZE, ttl=CACHE_TTL, path=CACHE_FILE)
+        if CACHE_FILE is not None:
+            cache.load()
+    return TranslationEngine(MODELS, executor=make_executor(EXECUTOR, WORKERS), cache=cache, workers=1 if EXECUTOR == 'inline' else WORKERS)
+
+
+_engine: Optional[TranslationEngine] = None
+_engine_loop: Optional[asyncio.AbstractEventLoop] = None
+_engine_thread: Optional[threading.Thread] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Tuple[asyncio.AbstractEventLoop, TranslationEngine]:
+    """
+    Returns the shared translation engine and the event loop it runs on.
+    On the first call the engine is created and the event loop is started in a background thread.
+
+    :return: The event loop and the translation engine.
+    """
+    global _engine, _engine_loop, _engine_thread
+    with _engine_lock:
+        if _engine is None:
+            _engine_loop = asyncio.new_event_loop()
+            _engine_thread = threading.Thread(target=_run_loop, args=(_engine_loop,), name='translation-engine', daemon=True)
+            _engine_thread.start()
+            _engine = create_engine()
+            log.info(f"Started translation engine, models={MODELS}, executor={EXECUTOR}")
+        return _engine_loop, _engine
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def shutdown() -> None:
+    """
+    Closes the shared translation engine and stops its event loop. Safe to call multiple times.
+    """
+    global _engine, _engine_loop, _engine_thread
+    with _engine_lock:
+        if _engine is None:
+            return
+        asyncio.run_coroutine_threadsafe(_engine.close(), _engine_loop).result()
+        _engine_loop.call_soon_threadsafe(_engine_loop.stop)
+        _engine_thread.join()
+        _engine_loop.close()
+        _engine, _engine_loop, _engine_thread = None, None, None
+        log.info("Stopped translation engine")
+
+
+atexit.register(shutdown)
+
+
+def handle_signals() -> None:
+    """
+    Shuts down the shared translation engine, which writes CACHE_FILE and KVISTUR_CACHE_FILE, when the process receives
+    SIGTERM or SIGINT, e.g. from "docker stop". The atexit handler is not run when the process is killed by SIGTERM.
+    Needs to be called from the main thread.
+    """
+    def stop(signum, frame):
+        log.info(f'Received signal={signum}, stopping')
+        shutdown()
+        raise SystemExit(128 + signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+
+
+def translate_stream(sentences: List[str], s_lang: str, t_lang: str, model: str, id: str, use_cache=True) -> Iterator[Tuple[int, str]]:
+    """
+    Preprocesses and translates the sentences from source language to target language on the shared translation engine.
+    Yields each translation with the index of its sentence as soon as it is ready.
 
     :param sentences: A list of sentences to translate.\n
     :param s_lang: The source language.\n
     :param t_lang: The target language.\n
     :param model: A string specifying the model.\n
-    :return: The translated sentences.
+    :param id: The UUID of the translation request.\n
+    :param use_cache: If False, the cached translations are not used.\n
+    :return: An iterator of (index, translated sentence), in the order the translations finish.
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    log.info(f"Defined models={MODELS}")
+    loop, engine = get_engine()
+    results: 'queue.Queue' = queue.Queue()
+    done = object()
 
     async def run():
-        translated = []
-        client = ServerProxy(MODELS[model], loop=loop, encoding='utf-8', timeout=ClientTimeout(total=60))
-        start = time()
-
         try:
-            tasks = [asyncio.create_task(translate(sentence, s_lang, t_lang, client, id)) for
-                     sentence in sentences]
-            translated = await asyncio.gather(*tasks)
-        except asyncio.TimeoutError as e:
-            log.error(f"Translation timed-out", e)
+            async for result in engine.translate_stream(sentences, s_lang, t_lang, model, id, use_cache=use_cache):
+                results.put(result)
+        except Exception as e:
+            results.put(e)
+        results.put(done)
 
-        end = time()
-        log.info(f"Bulk translation id={id}: took={end - start:.2f}")
-        await client.close()
-        return translated
+    future = asyncio.run_coroutine_threadsafe(run(), loop)
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                return
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        future.cancel()
 
-    translated = loop.run_until_complete(run())
-    loop.close()
-    return translated
+
+def translate_bulk(sentences: List[str], s_lang: str, t_lang: str, model: str, id: str, use_cache=True) -> List[str]:
+    """
+    Preprocesses and translates the sentences from source language to target language.
+    Uses the endpoint defined by model and preprocessing steps for the model.
+    Blocks until the translation is done on the shared translation engine.
+
+    :param sentences: A list of sentences to translate.\n
+    :param s_lang: The source language.\n
+    :param t_lang: The target language.\n
+    :param model: A string specifying the model.\n
+    :param id: The UUID of the translation request.\n
+    :param use_cache: If False, the cached translations are not used.\n
+    :return: The translated sentences.
+    """
+    loop, engine = get_engine()
+    return asyncio.run_coroutine_threadsafe(engine.translate_bulk(sentences, s_lang, t_lang, model, id, use_cache=use_cache), loop).result()
 
 
-async def translate(sent: str, s_lang: str, t_lang: str, proxy: ServerProxy, id: str) -> str:
+async def translate(sent: str,
+                    s_lang: str,
+                    t_lang: str,
+                    proxy: Union[ServerProxy, ModelClient],
+                    id: str,
+                    executor: Optional[Executor] = None,
+                    model='') -> str:
     """
     Preprocesses and translates the sentence from source language to target language.
     Uses the endpoint defined by model and preprocessing steps for the model.
@@ -139,24 +870,51 @@ async def translate(sent: str, s_lang: str, t_lang: str, proxy: ServerProxy, id:
     :param sent: The sentence to translate.\n
     :param s_lang: The source language.\n
     :param t_lang: The target language.\n
-    :param proxy: An XMLRPC proxy.\n
+    :param proxy: An XMLRPC proxy or a ModelClient.\n
     :param version: The preprocessing version\n
     :param id: The UUID of the translation request.\n
+    :param executor: Runs the pre- and postprocessing. None to run them on the event loop.\n
+    :param model: The name of the model, used in the metrics.\n
     :return: The translated sentence.
     """
     log.info(f"Translation id={id}: source={sent}")
 
-    sentence = preprocess(sent, s_lang)
+    start = time()
+    sentence = await run_in_executor(executor, preprocess, sent, s_lang)
+    metrics.PREPROCESS_SECONDS.observe(time() - start, model=model)
+    return await translate_preprocessed(sentence, t_lang, proxy, id, executor, model=model)
+
+
+async def translate_preprocessed(sentence: str,
+                                 t_lang: str,
+                                 proxy: Union[ServerProxy, ModelClient],
+                                 id: str,
+                                 executor: Optional[Executor] = None,
+                                 model='') -> str:
+    """
+    Translates the preprocessed sentence and postprocesses the translation.
+
+    :param sentence: The preprocessed sentence to translate.\n
+    :param t_lang: The target language.\n
+    :param proxy: An XMLRPC proxy or a ModelClient.\n
+    :param id: The UUID of the translation request.\n
+    :param executor: Runs the postprocessing. None to run it on the event loop.\n
+    :param model: The name of the model, used in the metrics.\n
+    :return: The translated sentence.
+    """
     log.info(f"Translation id={id}: preprocessed={sentence}")
 
     start = time()
     result = await proxy.translate({'text': sentence})
     end = time()
+    metrics.MOSES_SECONDS.observe(end - start, model=model)
     log.info(f"Translation id={id}: took={end - start:.2f}")
 
     translated = result['text']
     log.info(f"Translation id={id}: {sentence} -> {translated}")
 
-    translated = postprocess(translated, t_lang)
+    start = time()
+    translated = await run_in_executor(executor, postprocess, translated, t_lang)
+    metrics.POSTPROCESS_SECONDS.observe(time() - start, model=model)
     log.info(f"Translation id={id}: postprocessed={translated}")
     return translated
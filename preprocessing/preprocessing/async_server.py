@@ -0,0 +1,192 @@
+"""An asynchronous server front-end to an MT system, built on aiohttp. Implements the same RESTful interface as server.py.
+
+All requests are served on one event loop and share one translation engine, and thus one connection pool per model.
+"""
+import json
+import logging
+import uuid
+from typing import Dict, Any, Tuple, Optional
+
+from aiohttp import web
+
+from preprocessing import api as a
+from preprocessing import metrics
+
+log = logging.getLogger('frontend.async_server')
+
+ARGUMENTS = {
+    'contents': {'type': list, 'required': True, 'help': 'The sentence list to translate.'},
+    'sourceLanguageCode': {'type': str, 'required': True, 'choices': ('en', 'is'), 'help': 'The language code of the sentences.'},
+    'targetLanguageCode': {'type': str, 'required': True, 'choices': ('en', 'is'), 'help': 'The language code to translate to.'},
+    'model': {'type': str, 'required': True, 'help': 'The model to use to translate.'},
+    'useCache': {'type': bool, 'required': False, 'default': True, 'help': 'Set to false to bypass the translation cache.'},
+}
+"""The accepted arguments of /translateText, see server.py."""
+BOOLEANS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def parse_args(payload: Any) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """
+    Validates the JSON payload of a translation request in the same manner as the reqparse parser in server.py.
+
+    :param payload: The parsed JSON payload.\n
+    :return: The arguments and None, or None and the error message.
+    """
+    if not isinstance(payload, dict):
+        return {}, {'message': 'The request payload must be a JSON object.'}
+    unknown = [key for key in payload if key not in ARGUMENTS]
+    if unknown:
+        return {}, {'message': f'Unknown arguments: {", ".join(unknown)}'}
+    args = dict()
+    for name, argument in ARGUMENTS.items():
+        if name not in payload:
+            if argument['required']:
+                return {}, {'message': {name: argument['help']}}
+            args[name] = argument['default']
+            continue
+        value = payload[name]
+        # Like flask_restful.inputs.boolean
+        if argument['type'] is bool and isinstance(value, str) and value.lower() in BOOLEANS:
+            value = BOOLEANS[value.lower()]
+        if not isinstance(value, argument['type']) or value not in argument.get('choices', (value,)):
+            return {}, {'message': {name: argument['help']}}
+        args[name] = value
+    return args, None
+
+
+@web.middleware
+async def cors(request: web.Request, handler) -> web.StreamResponse:
+    """Allows requests from all origins, like flask_cors does for server.py."""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+async def ping(request: web.Request) -> web.Response:
+    """A dummy resource which responds if called.
+
+    :param path: / \n
+    :param method: GET\n
+    """
+    return web.json_response(None)
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    """The metrics of the translation server in the Prometheus text format.
+
+    :param path: /metrics \n
+    :param method: GET\n
+    """
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def translate(request: web.Request) -> web.Response:
+    """The translation endpoint. Accepts a list of sentences to translate and returns the results.
+    See server.MosesTranslate for the payload and response.
+
+    :param path: /translateText \n
+    :param method: POST \n
+    """
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    args, error = parse_args(payload)
+    if error is not None:
+        return web.json_response(error, status=400)
+    sentences = args['contents']
+    source_lang = args['sourceLanguageCode']
+    target_lang = args['targetLanguageCode']
+    model = args['model']
+    id = uuid.uuid4().hex
+    log.info(f"""Received translation request id={id}:
+    contents={sentences}
+    sourceLanguageCode={source_lang}
+    targetLanguageCode={target_lang}
+    model={model}""")
+    # We construct the model string so it fits what the api expects.
+    model = "-".join([source_lang, target_lang, model])
+    log.info(f"Parsed model string to model={model}")
+    translated_sentences = await request.app['engine'].translate_bulk(sentences, s_lang=source_lang, t_lang=target_lang, model=model, id=id,
+                                                                      use_cache=args['useCache'])
+    log.info(f"Sending translation response id={id}")
+    return web.json_response({
+        "translations": [
+            {
+                'translatedText': translation,
+                'model': model
+            }
+            for translation in translated_sentences
+        ]
+    })
+
+
+async def translate_stream(request: web.Request) -> web.StreamResponse:
+    """The streaming translation endpoint. Accepts the same payload as /translateText and streams each translation
+    as a line of JSON (NDJSON) as soon as it is ready. See server.MosesTranslateStream.
+
+    :param path: /translateTextStream \n
+    :param method: POST \n
+    """
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    args, error = parse_args(payload)
+    if error is not None:
+        return web.json_response(error, status=400)
+    source_lang = args['sourceLanguageCode']
+    target_lang = args['targetLanguageCode']
+    id = uuid.uuid4().hex
+    log.info(f"""Received streaming translation request id={id}:
+    contents={args['contents']}
+    sourceLanguageCode={source_lang}
+    targetLanguageCode={target_lang}
+    model={args['model']}""")
+    # We construct the model string so it fits what the api expects.
+    model = "-".join([source_lang, target_lang, args['model']])
+    # Errors which are known before the stream starts get an error status, like /translateText.
+    if model not in a.MODELS:
+        log.error(f"Unknown model={model} id={id}")
+        return web.json_response({'message': f'Unknown model={model}'}, status=500)
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    try:
+        async for index, translation in request.app['engine'].translate_stream(args['contents'], s_lang=source_lang, t_lang=target_lang,
+                                                                               model=model, id=id, use_cache=args['useCache']):
+            line = json.dumps({'index': index, 'translatedText': translation, 'model': model}, ensure_ascii=False) + '\n'
+            await response.write(line.encode('utf-8'))
+    except Exception as e:
+        # The status has been sent, a final error line tells the client that the stream is incomplete.
+        log.exception(f"Streaming translation failed id={id}")
+        await response.write((json.dumps({'error': a.describe_error(e)}) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def start_engine(app: web.Application) -> None:
+    app['engine'] = a.create_engine()
+
+
+async def close_engine(app: web.Application) -> None:
+    await app['engine'].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[cors])
+    app.router.add_get('/', ping)
+    app.router.add_post('/translateText', translate)
+    app.router.add_post('/translateTextStream', translate_stream)
+    app.router.add_get('/metrics', get_metrics)
+    app.on_startup.append(start_engine)
+    app.on_cleanup.append(close_engine)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=5000)
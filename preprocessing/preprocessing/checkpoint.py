@@ -0,0 +1,139 @@
+"""
+Checkpoints of long-running corpus jobs, so a job which is killed can be resumed instead of started over.
+
+The output is written by a CheckpointedOutput, which periodically flushes the output to disk and then atomically replaces
+a JSON checkpoint next to it, "<output>.checkpoint". The checkpoint records the number of input items (lines or files)
+which have been processed and the size of the output they produced. A resumed job truncates the output to that size,
+skips the processed input items and continues, so the output is byte-identical to an uninterrupted run.
+The checkpoint is removed when the job is done.
+"""
+from typing import Any, Dict, Optional
+import json
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger()
+
+VERSION = 1
+
+
+def checkpoint_path(output: str) -> str:
+    return f'{output}.checkpoint'
+
+
+def save_checkpoint(path: str, state: Dict[str, Any]) -> None:
+    """Writes the state as JSON and replaces the checkpoint atomically."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f_out:
+        json.dump(state, f_out)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> Optional[Dict[str, Any]]:
+    """
+    :return: The state of the checkpoint or None if there is no checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf8') as f_in:
+        state = json.load(f_in)
+    if state.get('version') != VERSION:
+        raise ValueError(f'Unsupported checkpoint={path}, version={state.get("version")}')
+    return state
+
+
+class CheckpointedOutput:
+    """
+    Writes the output of a job and checkpoints it at most every interval seconds. A checkpoint is only taken between
+    input items, see write().
+
+    Usage:
+        with CheckpointedOutput(output, params, resume=resume) as out:
+            for line in process(itertools.islice(input, out.done, None)):
+                out.write(line + '\\n')
+    """
+
+    def __init__(self, output: str, params: Dict[str, Any], resume=False, interval=60.0):
+        """
+        :param output: The output file. "-" writes to stdout without checkpoints.\n
+        :param params: The parameters of the job. A checkpoint is only resumed with the same parameters.\n
+        :param resume: Continue from the checkpoint of the output, if there is one. Otherwise the output is overwritten.\n
+        :param interval: The minimum number of seconds between checkpoints.
+        """
+        self.output = output
+        self.params = params
+        self.interval = interval
+        self.done = 0
+        """The number of input items processed, which are skipped when resuming."""
+        self.path: Optional[str] = None
+        if output == '-':
+            if resume:
+                raise ValueError('Unable to resume when writing to stdout')
+            self._file = sys.stdout.buffer
+            return
+        self.path = checkpoint_path(output)
+        state = load_checkpoint(self.path) if resume else None
+        if state is None:
+            if resume:
+                log.info(f'No checkpoint found, path={self.path}, starting from the beginning')
+            self._file = open(output, 'wb')
+        else:
+            if state['params'] != params:
+                raise ValueError(f'The checkpoint={self.path} was made with different parameters, params={state["params"]}')
+            size = os.path.getsize(output) if os.path.exists(output) else 0
+            if size < state['output_bytes']:
+                raise ValueError(f'The output={output} is shorter than its checkpoint={self.path}, bytes={size} < {state["output_bytes"]}')
+            os.truncate(output, state['output_bytes'])
+            self._file = open(output, 'ab')
+            self.done = state['input_items']
+            log.info(f'Resuming from checkpoint={self.path}, input items={self.done}, output bytes={state["output_bytes"]}')
+        self.checkpoint()
+
+    def write(self, text: str, items=1) -> None:
+        """
+        Writes the output of items input items, which are then processed.
+
+        :param text: The complete output of the items.\n
+        :param items: The number of input items, e.g. lines or files.
+        """
+        self._file.write(text.encode('utf-8'))
+        self.done += items
+        if self.path is not None and time.monotonic() - self._last_checkpoint >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Flushes the output to disk and records the number of processed input items and the size of the output."""
+        self._file.flush()
+        if self.path is None:
+            return
+        os.fsync(self._file.fileno())
+        save_checkpoint(self.path, dict(version=VERSION, params=self.params, input_items=self.done, output_bytes=self._file.tell()))
+        self._last_checkpoint = time.monotonic()
+
+    def close(self) -> None:
+        """Closes the output of a finished job and removes the checkpoint."""
+        self._file.flush()
+        if self.path is None:
+            return
+        self._file.close()
+        os.remove(self.path)
+        log.info(f'Done, input items={self.done}')
+
+    def __enter__(self) -> 'CheckpointedOutput':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        elif self.path is not None:
+            # Only complete items have been written, so the job can be resumed from here. If the checkpoint fails,
+            # the output after the last checkpoint is truncated when the job is resumed.
+            try:
+                self.checkpoint()
+            except OSError:
+                log.exception(f'Unable to checkpoint={self.path}')
+            self._file.close()
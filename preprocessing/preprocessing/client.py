@@ -1,3 +1,5 @@
+from typing import Iterable, Tuple
+import json
 from preprocessing.types import iCorpus
 from preprocessing import file_handler
 import logging
@@ -7,6 +9,10 @@ import requests
 log = logging.getLogger()
 
 
+class TranslationStreamError(Exception):
+    """The server failed after the translation stream had started, the stream is incomplete."""
+
+
 def translate_bulk(sentences: iCorpus, url: str, s_lang: str, t_lang: str, model: str, batch_size=20) -> iCorpus:
     for batch in file_handler.make_batches(sentences, batch_size=batch_size):
         response = requests.post(url=url, json={
@@ -19,3 +25,31 @@ def translate_bulk(sentences: iCorpus, url: str, s_lang: str, t_lang: str, model
             log.debug(f'Error in response: {response.text}')
         for translation in response.json()['translations']:
             yield translation['translatedText']
+
+
+def translate_stream(sentences: iCorpus, url: str, s_lang: str, t_lang: str, model: str, batch_size=20) -> Iterable[Tuple[int, str]]:
+    """
+    Translates the sentences using the streaming endpoint (/translateTextStream) and yields each translation as it arrives.
+
+    :return: An iterator of (index, translated sentence). The index is the position of the sentence in sentences.
+    :raises TranslationStreamError: If the stream ends with an error line.
+    """
+    offset = 0
+    for batch in file_handler.make_batches(sentences, batch_size=batch_size):
+        contents = [line for line in batch]
+        with requests.post(url=url, stream=True, json={
+            "contents": contents,
+            "sourceLanguageCode": s_lang,
+            "targetLanguageCode": t_lang,
+            "model": model
+        }) as response:
+            if not response.ok:
+                log.debug(f'Error in response: {response.text}')
+                response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    translation = json.loads(line)
+                    if 'error' in translation:
+                        raise TranslationStreamError(translation['error'])
+                    yield offset + translation['index'], translation['translatedText']
+        offset += len(contents)
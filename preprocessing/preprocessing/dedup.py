@@ -0,0 +1,217 @@
+"""
+Deduplication of (parallel) corpora which do not fit in memory as a set of sentences.
+
+The sentences are reduced to 64 or 128 bit fingerprints (blake2b). In the "fingerprint" mode the fingerprints are kept
+in an array backed hash table, 16 or 32 bytes per sentence at the most. In the "external" mode the fingerprints are
+partitioned to bucket files on disk and each bucket is deduplicated on its own, only a bit per sentence is kept in memory.
+"""
+from typing import Iterable, Iterator, Sequence, Tuple, Callable, Optional
+from array import array
+from hashlib import blake2b
+import logging
+import os
+import re
+import struct
+import tempfile
+
+log = logging.getLogger()
+
+MODES = ('exact', 'fingerprint', 'external')
+PUNCTUATION = re.compile(r'[^\w\s]|_')
+LOW_64 = (1 << 64) - 1
+
+
+def normalize(line: str) -> str:
+    """
+    The key of a line when deduplicating with normalization; lowercased, without punctuation and with collapsed white-space.
+    """
+    return " ".join(PUNCTUATION.sub('', line.casefold()).split())
+
+
+def fingerprint(key: str, bits=64) -> int:
+    """
+    :param key: The string to fingerprint.\n
+    :param bits: 64 or 128.\n
+    :return: A non-zero fingerprint of the key.
+    """
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=bits // 8).digest(), 'little') or 1
+
+
+class FingerprintSet:
+    """
+    An open-addressing hash set of 64 or 128 bit fingerprints, stored in an array of unsigned 64 bit integers.
+    The table is doubled when it is half full. 0 marks an empty slot, see fingerprint().
+    """
+
+    def __init__(self, bits=64, capacity=1 << 16):
+        if bits not in (64, 128):
+            raise ValueError(f'Unsupported bits={bits}')
+        self.words = bits // 64
+        self._len = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._table = array('Q', bytes(8 * self.words * capacity))
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _find(self, fingerprint: int) -> Tuple[int, bool]:
+        # The fingerprints are uniformly distributed, so the low bits are used as the slot.
+        table = self._table
+        index = fingerprint & self._mask
+        if self.words == 1:
+            while True:
+                current = table[index]
+                if current == fingerprint:
+                    return index, True
+                if current == 0:
+                    return index, False
+                index = (index + 1) & self._mask
+        high, low = fingerprint >> 64, fingerprint & LOW_64
+        while True:
+            current_high, current_low = table[2 * index], table[2 * index + 1]
+            if current_high == high and current_low == low:
+                return index, True
+            if current_high == 0 and current_low == 0:
+                return index, False
+            index = (index + 1) & self._mask
+
+    def __contains__(self, fingerprint: int) -> bool:
+        return self._find(fingerprint)[1]
+
+    def add(self, fingerprint: int) -> bool:
+        """
+        :return: True if the fingerprint was added, False if it was already in the set.
+        """
+        index, found = self._find(fingerprint)
+        if found:
+            return False
+        if self.words == 1:
+            self._table[index] = fingerprint
+        else:
+            self._table[2 * index] = fingerprint >> 64
+            self._table[2 * index + 1] = fingerprint & LOW_64
+        self._len += 1
+        if 2 * self._len > self._capacity:
+            self._grow()
+        return True
+
+    def _grow(self) -> None:
+        old, words = self._table, self.words
+        self._allocate(2 * self._capacity)
+        self._len = 0
+        for index in range(0, len(old), words):
+            if words == 1 and old[index] != 0:
+                self.add(old[index])
+            elif words == 2 and (old[index] != 0 or old[index + 1] != 0):
+                self.add(old[index] << 64 | old[index + 1])
+
+
+def _key_function(normalized: bool) -> Callable[[Tuple[str, ...]], str]:
+    if normalized:
+        return lambda lines: "\n".join(normalize(line) for line in lines)
+    return lambda lines: "\n".join(line.rstrip('\n') for line in lines)
+
+
+def deduplicate(corpora: Sequence[Iterable[str]],
+                mode='fingerprint',
+                bits=64,
+                normalized=False,
+                tmp_dir: Optional[str] = None,
+                buckets=256) -> Iterator[Tuple[str, ...]]:
+    """
+    Removes the repeated lines of a corpus, or the repeated line pairs of a parallel corpus. The first occurrence is kept.
+
+    :param corpora: The corpus, or both sides of a parallel corpus, as lines.\n
+    :param mode: "exact" keeps the lines in a set, "fingerprint" keeps their fingerprints in a FingerprintSet and "external"
+    deduplicates the fingerprints on disk. A collision of fingerprints removes a unique line. With 64 bits the chance of any
+    collision is about 1 in 2500 for 10^8 lines, with 128 bits it is negligible.\n
+    :param bits: The size of the fingerprints, 64 or 128.\n
+    :param normalized: Ignore the case, punctuation and white-space of the lines, see normalize().\n
+    :param tmp_dir: The directory for the temporary files of the "external" mode. Defaults to the system temp directory.\n
+    :param buckets: The number of bucket files in the "external" mode.\n
+    :return: The unique lines, a tuple of lines per corpus.
+    """
+    key = _key_function(normalized)
+    if mode == 'exact':
+        known = set()
+        results = _deduplicate_in_memory(zip(*corpora), lambda lines: _add(known, key(lines)))
+    elif mode == 'fingerprint':
+        fingerprints = FingerprintSet(bits=bits)
+        results = _deduplicate_in_memory(zip(*corpora), lambda lines: fingerprints.add(fingerprint(key(lines), bits)))
+    elif mode == 'external':
+        results = _deduplicate_external(corpora, key, bits=bits, tmp_dir=tmp_dir, buckets=buckets)
+    else:
+        raise ValueError(f'Unknown mode={mode}')
+    yield from results
+
+
+def _add(known: set, key: str) -> bool:
+    if key in known:
+        return False
+    known.add(key)
+    return True
+
+
+def _deduplicate_in_memory(lines: Iterable[Tuple[str, ...]], add: Callable[[Tuple[str, ...]], bool]) -> Iterator[Tuple[str, ...]]:
+    total = 0
+    removed = 0
+    for line in lines:
+        total += 1
+        if add(line):
+            yield line
+        else:
+            removed += 1
+    log.info(f'Total lines={total}, removed={removed}')
+
+
+def _deduplicate_external(corpora: Sequence[Iterable[str]],
+                          key: Callable[[Tuple[str, ...]], str],
+                          bits: int,
+                          tmp_dir: Optional[str],
+                          buckets: int) -> Iterator[Tuple[str, ...]]:
+    # Records of (fingerprint, line number), 64 bit words.
+    record = struct.Struct(f'<{bits // 64 + 1}Q')
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        # The input is copied, so it can be read from a pipe.
+        spools = [open(os.path.join(directory, f'corpus-{side}'), 'w+') for side in range(len(corpora))]
+        bucket_paths = [os.path.join(directory, f'bucket-{bucket}') for bucket in range(buckets)]
+        bucket_files = [open(path, 'wb', buffering=1 << 16) for path in bucket_paths]
+        total = 0
+        try:
+            for lines in zip(*corpora):
+                for spool, line in zip(spools, lines):
+                    spool.write(line if line.endswith('\n') else line + '\n')
+                value = fingerprint(key(lines), bits)
+                words = (value,) if bits == 64 else (value >> 64, value & LOW_64)
+                bucket_files[value % buckets].write(record.pack(*words, total))
+                total += 1
+            for bucket_file in bucket_files:
+                bucket_file.close()
+
+            # A bucket holds about total / buckets fingerprints, in the order of the lines.
+            keep = bytearray((total + 7) // 8)
+            for path in bucket_paths:
+                seen = set()
+                with open(path, 'rb') as f_in:
+                    for *words, line_number in record.iter_unpack(f_in.read()):
+                        words = tuple(words)
+                        if words not in seen:
+                            seen.add(words)
+                            keep[line_number >> 3] |= 1 << (line_number & 7)
+                os.remove(path)
+
+            kept = 0
+            for spool in spools:
+                spool.seek(0)
+            for line_number, lines in enumerate(zip(*spools)):
+                if keep[line_number >> 3] & (1 << (line_number & 7)):
+                    kept += 1
+                    yield lines
+            log.info(f'Total lines={total}, removed={total - kept}')
+        finally:
+            for spool in spools + bucket_files:
+                spool.close()
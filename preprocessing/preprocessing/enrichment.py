@@ -0,0 +1,223 @@
+"""
+An asynchronous client for the Icelandic lemmatization and POS tagging service, see URL.
+
+The sentences are sent in chunks over a pooled aiohttp session, with at most a given number of requests in flight.
+Failed requests are retried with exponential backoff. The results are returned in the order of the sentences.
+Enriched sentences are kept in an on-disk cache, keyed by the hash of the sentence, so a re-run only sends the new sentences.
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+from hashlib import blake2b
+import asyncio
+import itertools
+import json
+import logging
+import os
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError, ClientResponseError
+
+from preprocessing.types import EnrichedSentence
+
+log = logging.getLogger()
+
+URL = os.environ.get('ENRICHMENT_URL', 'http://malvinnsla.arnastofnun.is')
+"""The URL of the service. Set with the environment variable ENRICHMENT_URL."""
+CONCURRENCY = int(os.environ.get('ENRICHMENT_CONCURRENCY', 4))
+"""The maximum number of requests in flight. Set with the environment variable ENRICHMENT_CONCURRENCY."""
+CACHE_FILE = os.environ.get('ENRICHMENT_CACHE', None)
+"""If set, enriched sentences are kept in this file between runs, see EnrichmentCache. To set:
+
+export ENRICHMENT_CACHE=/data/enrichment-cache.jsonl
+"""
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def sentence_key(sentence: str) -> str:
+    """
+    :return: The key of a sentence in the EnrichmentCache. Surrounding white-space is ignored.
+    """
+    return blake2b(sentence.strip().encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EnrichmentCache:
+    """
+    Enriched sentences by sentence_key(). The cache is loaded into memory and new entries are appended to a file,
+    a JSON list of the key, the forms, the POS tags and the lemmas per line. A partially written last line is skipped.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: The cache file. If None, the cache is only kept in memory.
+        """
+        self.path = path
+        self._entries: Dict[str, EnrichedSentence] = dict()
+        self._file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f_in:
+                for line in f_in:
+                    try:
+                        key, forms, poss, lemmas = json.loads(line)
+                    except ValueError:
+                        log.warning(f'Skipping a malformed line in enrichment cache={path}')
+                        continue
+                    self._entries[key] = (forms, poss, lemmas)
+            log.info(f'Loaded enrichment cache={path}, size={len(self._entries)}')
+        self._file = open(path, 'a', encoding='utf8')
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[EnrichedSentence]:
+        return self._entries.get(key)
+
+    def put(self, key: str, enriched: EnrichedSentence) -> None:
+        self._entries[key] = enriched
+        if self._file is not None:
+            self._file.write(json.dumps([key, *enriched], ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def parse_response(response: Dict) -> List[EnrichedSentence]:
+    """
+    :param response: The JSON response of the service.\n
+    :return: The forms, POS tags and lemmas of each paragraph, i.e. each line sent.
+    """
+    enriched_sentences = []
+    for paragraph in response['paragraphs']:
+        forms: List[str] = []
+        poss: List[str] = []
+        lemmas: List[str] = []
+        for sentence in paragraph['sentences']:
+            for token in sentence:
+                forms.append(token['word'])
+                poss.append(token['tag'])
+                lemmas.append(token['lemma'])
+        enriched_sentences.append((forms, poss, lemmas))
+    return enriched_sentences
+
+
+class EnrichmentClient:
+    """
+    Enriches Icelandic sentences with the service at url, see the module documentation.
+    Needs to be created and used on the same event loop.
+    """
+
+    def __init__(self,
+                 url=URL,
+                 concurrency=CONCURRENCY,
+                 chunksize=100,
+                 retries=3,
+                 backoff=1.0,
+                 timeout=60.0,
+                 cache: Optional[EnrichmentCache] = None):
+        """
+        :param url: The URL of the service.\n
+        :param concurrency: The maximum number of requests in flight.\n
+        :param chunksize: The number of sentences sent in a single request.\n
+        :param retries: The number of times a failed request is retried.\n
+        :param backoff: The wait before the first retry, in seconds. The wait is doubled after each retry.\n
+        :param timeout: The timeout of a single request, in seconds.\n
+        :param cache: The cache of enriched sentences.
+        """
+        self.url = url
+        self.chunksize = chunksize
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache if cache is not None else EnrichmentCache()
+        self.requests = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.session = ClientSession(connector=TCPConnector(limit=concurrency), timeout=ClientTimeout(total=timeout))
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def _post(self, sentences: Sequence[str]) -> List[EnrichedSentence]:
+        # A line is a paragraph for the service.
+        data = {
+            'text': "".join(sentence.strip() + '\n' for sentence in sentences),
+            'lemma': 'on'
+        }
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    self.requests += 1
+                    async with self.session.post(self.url, data=data) as response:
+                        response.raise_for_status()
+                        enriched = parse_response(await response.json(content_type=None))
+                if len(enriched) != len(sentences):
+                    raise ValueError(f'Expected sentences={len(sentences)}, got={len(enriched)} from url={self.url}')
+                return enriched
+            except (ClientError, asyncio.TimeoutError) as error:
+                if attempt >= self.retries or (isinstance(error, ClientResponseError) and error.status not in RETRY_STATUSES):
+                    raise
+                wait = self.backoff * 2 ** attempt
+                log.warning(f'Enrichment request failed, retrying in={wait:.1f}s, attempt={attempt + 1}, error={error!r}')
+                await asyncio.sleep(wait)
+                attempt += 1
+
+    async def _enrich_chunk(self, keys: List[str], sentences: List[str]) -> None:
+        # Each chunk is cached once it is done, so a failed run keeps the chunks which succeeded.
+        for key, enriched in zip(keys, await self._post(sentences)):
+            self.cache.put(key, enriched)
+
+    async def enrich(self, sentences: Sequence[str]) -> List[EnrichedSentence]:
+        """
+        Enriches the sentences which are not cached, chunksize sentences per request, and caches them.
+        Empty sentences are not sent.
+
+        :return: The forms, POS tags and lemmas of each sentence, in the order of the sentences.
+        """
+        keys = [sentence_key(sentence) for sentence in sentences]
+        # The sentences which are not cached, each only once.
+        missing: Dict[str, str] = dict()
+        for key, sentence in zip(keys, sentences):
+            if sentence.strip() != '' and self.cache.get(key) is None and key not in missing:
+                missing[key] = sentence
+        missing_keys = list(missing)
+        chunks = [missing_keys[start:start + self.chunksize] for start in range(0, len(missing_keys), self.chunksize)]
+        await asyncio.gather(*(self._enrich_chunk(chunk, [missing[key] for key in chunk]) for chunk in chunks))
+        log.debug(f'Enriched sentences={len(sentences)}, cached={len(sentences) - len(missing)}, requests={len(chunks)}')
+        return [self.cache.get(key) if sentence.strip() != '' else ([], [], []) for key, sentence in zip(keys, sentences)]
+
+
+def enrich_corpus(corpus: Iterable[str],
+                  url=URL,
+                  concurrency=CONCURRENCY,
+                  chunksize=100,
+                  retries=3,
+                  backoff=1.0,
+                  cache_path: Optional[str] = CACHE_FILE) -> Iterator[EnrichedSentence]:
+    """
+    Enriches an Icelandic corpus, see EnrichmentClient. The corpus is read in windows of 2 * concurrency * chunksize
+    sentences, so the memory used does not depend on the size of the corpus (other than the cache).
+
+    :param cache_path: The file of the EnrichmentCache. If None, the results are not kept between runs.\n
+    :return: The forms, POS tags and lemmas of each sentence, in the order of the corpus.
+    """
+    loop = asyncio.new_event_loop()
+    cache = EnrichmentCache(cache_path)
+    client: Optional[EnrichmentClient] = None
+
+    async def create_client() -> EnrichmentClient:
+        return EnrichmentClient(url=url, concurrency=concurrency, chunksize=chunksize, retries=retries, backoff=backoff, cache=cache)
+
+    try:
+        client = loop.run_until_complete(create_client())
+        corpus = iter(corpus)
+        while True:
+            window = list(itertools.islice(corpus, 2 * concurrency * chunksize))
+            if len(window) == 0:
+                break
+            yield from loop.run_until_complete(client.enrich(window))
+        log.info(f'Enrichment requests={client.requests}, cache size={len(cache)}')
+    finally:
+        if client is not None:
+            loop.run_until_complete(client.close())
+        loop.close()
+        cache.close()
@@ -1,7 +1,9 @@
 import logging
+import os
 import pathlib
-from typing import List
-from concurrent.futures import ProcessPoolExecutor
+from typing import List, Callable, Iterable, Iterator, Optional, Any, Deque, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 from functools import partial
 import itertools
 from xml.etree import ElementTree as ET
@@ -30,6 +32,18 @@ def deserialize(path: str) -> iCorpus:
             yield line
 
 
+def count_lines(path: str) -> int:
+    """Counts the lines of a file, reading it in binary blocks."""
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # The last line does not need to end with a newline
+    return lines if last == b'\n' else lines + 1
+
+
 def make_batches(sequence, batch_size: int):
     sourceiter = iter(sequence)
     while True:
@@ -40,6 +54,54 @@ def make_batches(sequence, batch_size: int):
             return
 
 
+def map_chunk(f: Callable, chunk: List) -> List:
+    """Applies f to each item of the chunk. Used with parallel_map() for functions which process a single item."""
+    return [f(item) for item in chunk]
+
+
+def parallel_map(f: Callable[[List], Any],
+                 items: Iterable,
+                 threads: int,
+                 chunksize: int,
+                 max_in_flight: Optional[int] = None,
+                 initializer: Optional[Callable] = None,
+                 initargs: Tuple = ()) -> Iterator[Any]:
+    """
+    Applies f to chunks of the items on multiple processes and yields the results, f(chunk), in the order of the items.
+
+    At most max_in_flight chunks (default 2 * threads) are submitted at a time, so reading the items, processing them
+    and consuming the results overlap and the memory used does not depend on the number of items.
+    With a single thread the chunks are processed in this process.
+
+    :param f: A picklable function which processes a list of items.\n
+    :param items: The items, read lazily.\n
+    :param threads: The number of processes.\n
+    :param chunksize: The number of items sent to a process at a time.\n
+    :param max_in_flight: The maximum number of chunks submitted and not yet consumed.\n
+    :param initializer: Called with initargs once in each process, e.g. to load models. Not called with a single thread.\n
+    :param initargs: The arguments of the initializer, sent once per process.\n
+    :return: The results of f for each chunk.
+    """
+    if threads == 1:
+        for chunk in make_batches(items, batch_size=chunksize):
+            yield f(list(chunk))
+        return
+    max_in_flight = max_in_flight or 2 * threads
+    in_flight: Deque[Future] = deque()
+    with ProcessPoolExecutor(max_workers=threads, initializer=initializer, initargs=initargs) as executor:
+        try:
+            for chunk in make_batches(items, batch_size=chunksize):
+                in_flight.append(executor.submit(f, list(chunk)))
+                if len(in_flight) >= max_in_flight:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # If the consumer stops early, the chunks which have not started are dropped.
+            for future in in_flight:
+                future.cancel()
+
+
 def get_kvistur_resources():
     return {
         "modifiers": str(pathlib.Path(__file__).resolve().parent.parent.joinpath('kvistur').joinpath('resources').joinpath('modifiers.dawg')),
@@ -49,44 +111,96 @@ def get_kvistur_resources():
     }
 
 
-def read_rmh_file(path: str):
+TEI = '{http://www.tei-c.org/ns/1.0}'
+
+
+def iter_rmh_file(path: str) -> Iterator[Tuple[str, ...]]:
     """
-    Reads a single RMH file and returns a TokCorpus.
+    Reads a single RMH file incrementally and yields the tokens of each sentence in the paragraphs of the body.
+    The elements of the body are cleared and removed from their parents once they have been read, so the memory used
+    does not depend on the size of the file.
 
     Adjusted code from xml_tools.py from Róbert Kjaran <robert@kjaran.com>
     """
     log.debug(f'Processing file={path}')
-    NS = {'a': 'http://www.tei-c.org/ns/1.0'}
-    root = ET.parse(str(path)).getroot()
-    # We gather all the paragraphs from the body, avoiding the divs
-    return [tuple((token_node.text for token_node in sentence_node.findall('./*') if token_node.text is not None))
-            for paragraph_node in root.findall('.//a:body//a:p', NS)
-            for sentence_node in paragraph_node.findall('.//a:s', NS)]
+    body_depth = 0
+    paragraph_depth = 0
+    parents: List[ET.Element] = []
+    for event, element in ET.iterparse(str(path), events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            if element.tag == f'{TEI}body':
+                body_depth += 1
+            elif element.tag == f'{TEI}p' and body_depth > 0:
+                paragraph_depth += 1
+            continue
+        parents.pop()
+        if element.tag == f'{TEI}body':
+            body_depth -= 1
+            continue
+        if element.tag == f'{TEI}p' and body_depth > 0:
+            paragraph_depth -= 1
+        elif element.tag == f'{TEI}s' and paragraph_depth > 0:
+            yield tuple(token_node.text for token_node in element if token_node.text is not None)
+            element.clear()
+        # Drops the consumed paragraphs, and everything else in the body outside of them, from the tree.
+        if body_depth > 0 and paragraph_depth == 0:
+            element.clear()
+            parents[-1].remove(element)
+
+
+def read_rmh_file(path: str) -> List[Tuple[str, ...]]:
+    """
+    Reads a single RMH file and returns a TokCorpus, see iter_rmh_file().
+    """
+    return list(iter_rmh_file(path))
+
+
+def sort_rmh_files(files: List[str]) -> List[str]:
+    """
+    :return: The files, the largest first. Files of the same size are sorted by path, so the order is the same for each run.
+    """
+    return sorted(files, key=lambda path: (-os.path.getsize(path), path))
+
+
+def read_rmh_files(files: List[str], threads=1, chunksize=1, skip=0, max_in_flight: Optional[int] = None) -> Iterator[List[Tuple[str, ...]]]:
+    """
+    Reads RMH files in the order of sort_rmh_files() and yields the sentences of each file.
+
+    The files are handed to the threads in batches of chunksize and an idle thread takes the next batch, see parallel_map().
+    The results are yielded in order, so a resumed job can skip the files which were done. This limits the work stealing:
+    while the oldest batch is read, the other threads can only read ahead up to max_in_flight batches, and then wait.
+    Since the largest files are read first, the oldest batch is usually the largest one in flight, so a read-ahead of
+    max_in_flight - 1 smaller batches covers it in most cases. The sentences of the batches in flight are held in memory.
+
+    :param skip: The number of (sorted) files to skip, e.g. the files already read by a resumed job.\n
+    :param max_in_flight: The maximum number of batches read ahead of the output, default 4 * threads.
+    """
+    files = sort_rmh_files(files)[skip:]
+    max_in_flight = max_in_flight or 4 * threads
+    with tqdm(total=len(files)) as progress:
+        for results in parallel_map(partial(map_chunk, read_rmh_file), files, threads=threads, chunksize=chunksize,
+                                    max_in_flight=max_in_flight):
+            for result in results:
+                progress.update(1)
+                yield result
 
 
-def rmh_2_corpus(files: List[str], threads=1, chunksize=100) -> iTokCorpus:
+def rmh_2_corpus(files: List[str], threads=1, chunksize=1) -> iTokCorpus:
     """
     Reads RMH files and extracts the tokens, including punctuations. Returns a TokCorpus.
 
-    Multiple threads are used to process batches (of size chunksize) of files together.
+    The largest files are read first, see read_rmh_files(). The sentences are yielded in the order of the files,
+    so the output is the same for each run.
     """
-    with ProcessPoolExecutor(max_workers=threads) as executor:
-        results = tqdm(executor.map(
-            read_rmh_file,
-            files,
-            chunksize=chunksize),
-            total=len(files))
-        for result in results:
-            yield from result
+    for sentences in read_rmh_files(files, threads=threads, chunksize=chunksize):
+        yield from sentences
 
 
 def write_moses(corpus: EnrichedCorpus, output_file, threads: int, chunksize: int, write_form: bool, write_pos: bool, write_lemma: bool) -> None:
     with open(output_file, 'w+') as f_out:
-        with ProcessPoolExecutor(max_workers=threads) as executor:
-            results = tqdm(executor.map(
-                partial(get_moses_line, write_form=write_form, write_pos=write_pos, write_lemma=write_lemma),
-                corpus,
-                chunksize=chunksize))
+        f = partial(map_chunk, partial(get_moses_line, write_form=write_form, write_pos=write_pos, write_lemma=write_lemma))
+        for results in tqdm(parallel_map(f, corpus, threads=threads, chunksize=chunksize)):
             for result in results:
                 f_out.write(result)
 
@@ -94,11 +208,11 @@ def write_moses(corpus: EnrichedCorpus, output_file, threads: int, chunksize: in
 def get_moses_line(line: EnrichedSentence, write_form: bool, write_pos: bool, write_lemma: bool) -> str:
     form, pos, lemma = line
     if write_form:
-        form = list(pipeline.escape_moses_chars((token for token in form)))
+        form = pipeline.escape_tokens(form)
     if write_pos:
-        pos = list(pipeline.escape_moses_chars((token for token in pos)))
+        pos = pipeline.escape_tokens(pos)
     if write_lemma:
-        lemma = list(pipeline.escape_moses_chars((token for token in lemma)))
+        lemma = pipeline.escape_tokens(lemma)
     # Only form
     if write_form and not write_pos and not write_lemma:
         return " ".join(form) + "\n"
@@ -0,0 +1,160 @@
+"""
+Metrics of the translation server, exposed in the Prometheus text format on /metrics.
+
+The metrics are labelled by model so the slow stage of a model can be found under load.
+"""
+from typing import Dict, List, Tuple, Sequence
+import threading
+import bisect
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry:
+    """Holds the metrics which are rendered together."""
+
+    def __init__(self):
+        self.metrics: List['Metric'] = []
+
+    def register(self, metric: 'Metric') -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        :return: All the metrics in the Prometheus text exposition format.
+        """
+        return "".join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """A metric with a value per combination of label values."""
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ('model',), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'Expected labels={self.labels}, got={tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n' + "".join(self._render_samples())
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value which only goes up."""
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = dict()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}\n' for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value which can go up and down."""
+    type = 'gauge'
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Counts the observed values, e.g. durations in seconds, in cumulative buckets."""
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per label values: the count per bucket (not cumulative), the sum and the count.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0, 0.0])
+            counts, total = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+            total[1] += 1
+
+    def get_count(self, **labels: str) -> int:
+        key = self._key(labels)
+        return int(self._values[key][1][1]) if key in self._values else 0
+
+    def _render_samples(self) -> List[str]:
+        samples = []
+        with self._lock:
+            for key, (counts, (total, count)) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels + ('le',), key + (_format_value(bound),))
+                    samples.append(f'{self.name}_bucket{labels} {cumulative}\n')
+                samples.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}\n')
+                samples.append(f'{self.name}_count{_format_labels(self.labels, key)} {int(count)}\n')
+        return samples
+
+
+PREPROCESS_SECONDS = Histogram('translation_preprocess_seconds', 'Time spent preprocessing a sentence.')
+MOSES_SECONDS = Histogram('translation_moses_seconds', 'Time spent waiting for Moses to translate a sentence.')
+POSTPROCESS_SECONDS = Histogram('translation_postprocess_seconds', 'Time spent postprocessing a sentence.')
+REQUEST_SECONDS = Histogram('translation_request_seconds', 'Time spent on a translation request.')
+SENTENCES = Counter('translation_sentences_total', 'The number of sentences requested for translation.')
+ERRORS = Counter('translation_errors_total', 'The number of failed translation requests.')
+TIMEOUTS = Counter('translation_timeouts_total', 'The number of timed-out translation requests.')
+REQUESTS_IN_FLIGHT = Gauge('translation_requests_in_flight', 'The number of translation requests being processed.')
+MOSES_IN_FLIGHT = Gauge('translation_moses_calls_in_flight', 'The number of calls to Moses waiting for a response.')
+
+
+def render() -> str:
+    """
+    :return: All the translation metrics in the Prometheus text exposition format.
+    """
+    return REGISTRY.render()
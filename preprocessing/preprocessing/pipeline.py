@@ -1,17 +1,21 @@
 from time import time
 from collections import defaultdict
-from typing import Dict, Callable, Tuple, Set, Iterable, List
+from typing import Dict, Tuple, Set, Iterable, List, Optional, Any, Sequence
+from collections import OrderedDict
 import logging
+import json
+import itertools
+import random
+import os
 import re
-from concurrent.futures import ProcessPoolExecutor
+import threading
 from functools import partial
 import pathlib
 
-import requests
 from nltk.corpus import wordnet as wn
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk import pos_tag
-from sacremoses import MosesTokenizer, MosesTruecaser, MosesDetokenizer, MosesDetruecaser
+from sacremoses import MosesTokenizer, MosesDetokenizer, MosesDetruecaser
 import tokenizer as mideind_tok
 from tqdm import tqdm
 import sentencepiece as spm
@@ -20,6 +24,8 @@ from preprocessing.types import (Lang, Tokens, POS, Lemma,
                                  iTokCorpus, iCorpus, iEnrichedCorpus,
                                  Corpus, EnrichedCorpus)
 from preprocessing import file_handler
+from preprocessing import truecaser as p_truecaser
+from preprocessing import enrichment
 
 log = logging.getLogger()
 
@@ -27,17 +33,18 @@ tag_map: Dict[str, str] = defaultdict(lambda: wn.NOUN)
 tag_map['J'] = wn.ADJ
 tag_map['V'] = wn.VERB
 tag_map['R'] = wn.ADV
-URL = 'http://malvinnsla.arnastofnun.is'
+URL = enrichment.URL
+KVISTUR_CACHE_SIZE = 1000000
 
 
 lazy_objects: Dict[str, object] = dict()
 
 
-def _lazy_load_moses_truecaser(load_from):
+def _lazy_load_truecaser(load_from) -> p_truecaser.Truecaser:
     global lazy_objects
-    if load_from not in lazy_objects:
-        lazy_objects[load_from] = MosesTruecaser(load_from=load_from)
-    return lazy_objects[load_from]
+    if f'truecaser_{load_from}' not in lazy_objects:
+        lazy_objects[f'truecaser_{load_from}'] = p_truecaser.Truecaser(load_from)
+    return lazy_objects[f'truecaser_{load_from}']
 
 
 def _lazy_load_bpe_tokenizer(lang, model=""):
@@ -84,6 +91,141 @@ def _lazy_load_kvistur():
     return lazy_objects['kvistur']
 
 
+class CompoundSplitCache:
+    """
+    A bounded LRU memo of Kvistur compound splits; token -> the parts of the token separated by a space.
+    The same rare compounds show up many times in a corpus, and Kvistur is the slowest per-token step.
+
+    Each process has its own cache, see load_split_cache(). A worker hands its new splits to the parent with delta()
+    and the parent merges them with merge(). The threads of a process share its cache, so it is guarded by a lock.
+    """
+
+    def __init__(self, max_size: int = KVISTUR_CACHE_SIZE, path: Optional[str] = None):
+        """
+        :param max_size: The maximum number of cached splits, the least recently used are evicted.\n
+        :param path: The file the cache is loaded from and saved to. None to keep the cache in memory only.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, str]' = OrderedDict()
+        self._new: Dict[str, str] = dict()
+        self._new_hits = 0
+        self._new_misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            split = self._entries.get(token)
+            if split is None:
+                self.misses += 1
+                self._new_misses += 1
+                return None
+            self.hits += 1
+            self._new_hits += 1
+            self._entries.move_to_end(token)
+            return split
+
+    def put(self, token: str, split: str) -> None:
+        with self._lock:
+            self._put(token, split)
+
+    def _put(self, token: str, split: str) -> None:
+        self._entries[token] = split
+        self._entries.move_to_end(token)
+        # Bounded as well, in case delta() is never called.
+        if len(self._new) < self.max_size:
+            self._new[token] = split
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delta(self) -> Dict[str, Any]:
+        """
+        :return: The splits added and the hits and misses since the last call.
+        """
+        with self._lock:
+            delta = {'splits': self._new, 'hits': self._new_hits, 'misses': self._new_misses}
+            self._new = dict()
+            self._new_hits = 0
+            self._new_misses = 0
+        return delta
+
+    def merge(self, delta: Dict[str, Any]) -> None:
+        """
+        Adds the splits and statistics of another cache, see delta().
+        """
+        with self._lock:
+            for token, split in delta['splits'].items():
+                self._put(token, split)
+            self.hits += delta['hits']
+            self.misses += delta['misses']
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        Writes the cached splits to a JSON file, oldest used first. The file is replaced atomically.
+        """
+        path = path or self.path
+        tmp_path = f'{path}.tmp'
+        with self._lock:
+            entries = list(self._entries.items())
+        with open(tmp_path, 'w') as f_out:
+            json.dump(entries, f_out, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        log.info(f'Saved compound split cache={path}, size={len(self._entries)}')
+
+    def load(self, path: Optional[str] = None) -> None:
+        """
+        Reads cached splits written by save(). Does nothing if the file does not exist.
+        """
+        path = path or self.path
+        if not os.path.exists(path):
+            return
+        with open(path) as f_in:
+            entries = json.load(f_in)
+        with self._lock:
+            for token, split in entries:
+                self._entries[token] = split
+                self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        log.info(f'Loaded compound split cache={path}, size={len(self._entries)}')
+
+
+def load_split_cache(path: Optional[str] = None) -> CompoundSplitCache:
+    """
+    Returns the compound split cache of this process, loaded from path on first use.
+
+    :param path: The file of the cache. None for a cache which is only kept in memory.\n
+    :return: The cache.
+    """
+    global lazy_objects
+    if f'kvistur_cache_{path}' not in lazy_objects:
+        cache = CompoundSplitCache(path=path)
+        if path is not None:
+            cache.load()
+        lazy_objects[f'kvistur_cache_{path}'] = cache
+    return lazy_objects[f'kvistur_cache_{path}']
+
+
+def split_compound(token: str, cache: CompoundSplitCache) -> str:
+    """
+    Splits the token with Kvistur, "x_y" -> "x y". Returns the token unchanged if it is not a compound.
+    """
+    split = cache.get(token)
+    if split is None:
+        split = _lazy_load_kvistur().re_split(token).replace("_", " ")
+        cache.put(token, split)
+    return split
+
+
 def get_index_of_segment(segment):
     if segment == 'form':
         return 0
@@ -125,54 +267,85 @@ illegal_replace = [
 ]
 
 
+# The illegal_replace table as plain string replacements. Chained str.replace calls scan the line in C and are
+# several times faster than a regex alternation or str.translate with multi-character replacements.
+ESCAPES = tuple((keywords['unicode'], keywords['repl'].pattern) for keywords in illegal_replace)
+# The placeholders are replaced in a single left to right scan. Replacing them one after another is not reversible,
+# e.g. "<pipe|" -> "_lt_pipe_pipe_" would share the "_" between "_lt_" and the following "_pipe_".
+UNESCAPES = {placeholder: char for char, placeholder in ESCAPES}
+UNESCAPE_PATTERN = re.compile('|'.join(re.escape(placeholder) for _, placeholder in ESCAPES))
+
+
+def _unescape(match) -> str:
+    return UNESCAPES[match.group()]
+
+
+def escape_line(line: str) -> str:
+    """
+    Replaces the characters Moses does not accept, "|" -> "_pipe_", "<" -> "_lt_" and so on, see illegal_replace.
+    """
+    for char, placeholder in ESCAPES:
+        line = line.replace(char, placeholder)
+    return line
+
+
+def de_escape_line(line: str) -> str:
+    """
+    Reverses escape_line().
+    """
+    # All the placeholders contain "_"
+    if '_' not in line:
+        return line
+    return UNESCAPE_PATTERN.sub(_unescape, line)
+
+
+def escape_tokens(tokens: Iterable[str]) -> List[str]:
+    return [escape_line(token) for token in tokens]
+
+
+def de_escape_tokens(tokens: Iterable[str]) -> List[str]:
+    return [de_escape_line(token) for token in tokens]
+
+
 def escape_moses_chars(corpus: iCorpus) -> iCorpus:
     for sent in corpus:
-        for keywords in illegal_replace:
-            sent = keywords['pattern'].sub(string=sent, repl=keywords['repl'].pattern)
-        yield sent
+        yield escape_line(sent)
 
 
 def de_escape_moses_chars(corpus: iCorpus) -> iCorpus:
     for sent in corpus:
-        for keywords in illegal_replace:
-            sent = keywords['repl'].sub(string=sent, repl=keywords['unicode'])
-        yield sent
+        yield de_escape_line(sent)
 
 
-def enrich(corpus: iCorpus, lang: str, chunksize: int, lines: int) -> iEnrichedCorpus:
+def enrich(corpus: iCorpus,
+           lang: str,
+           chunksize: int,
+           lines: int,
+           concurrency=enrichment.CONCURRENCY,
+           cache_path: Optional[str] = enrichment.CACHE_FILE) -> iEnrichedCorpus:
     """Enrich the given corpus with POS and lemma.
     English processing is offline.
-    Icelandic processing is done via online API.
+    Icelandic processing is done via online API, with concurrent requests, see enrichment.enrich_corpus().
+
+    :param lines: Only enrich the first lines of the corpus. 0 for all.\n
+    :param concurrency: The maximum number of requests in flight, Icelandic only.\n
+    :param cache_path: The file of the enrichment cache, Icelandic only. None to not keep the results between runs.
     """
     log.info(f'Enriching')
-    function: Callable[[iCorpus], EnrichedCorpus] = enrich_sentences_en if lang == 'en' else enrich_sentences_is
+    if lines > 0:
+        corpus = itertools.islice(corpus, lines)
+    if lang == 'is':
+        yield from enrichment.enrich_corpus(corpus, url=URL, concurrency=concurrency, chunksize=chunksize, cache_path=cache_path)
+        return
     for chunk in file_handler.make_batches(corpus, batch_size=chunksize):
         start = time()
-        yield from function(chunk)
+        yield from enrich_sentences_en(chunk)
         end = time()
         log.debug(f"Bulk enrichment took={end - start:.2f}")
 
 
-def enrich_sentences_is(corpus: iCorpus) -> EnrichedCorpus:
-    enriched_sentences = []
-    data = {
-        'text': "".join(corpus),
-        'lemma': 'on'
-    }
-    log.debug(f'Request data={data}')
-    json = requests.post(URL, data=data).json()
-    log.debug(f'Response json={json}')
-    for paragraph in json['paragraphs']:
-        forms: Tokens = []
-        poss: POS = []
-        lemmas: Lemma = []
-        for sentence in paragraph['sentences']:
-            for token in sentence:
-                forms.append(token['word'])
-                poss.append(token['tag'])
-                lemmas.append(token['lemma'])
-        enriched_sentences.append((forms, poss, lemmas))
-    return enriched_sentences
+def enrich_sentences_is(corpus: iCorpus, concurrency=enrichment.CONCURRENCY, cache_path: Optional[str] = enrichment.CACHE_FILE) -> EnrichedCorpus:
+    return list(enrichment.enrich_corpus(corpus, url=URL, concurrency=concurrency, cache_path=cache_path))
 
 
 def enrich_sentences_en(corpus: iCorpus) -> EnrichedCorpus:
@@ -211,7 +384,17 @@ def en_tok(line, tokenizer: str, model=""):
         raise ValueError(f'Unknown tokenizer={tokenizer}')
 
 
-def tokenize(corpus: iCorpus, lang: Lang, tokenizer="", model="", threads=1, batch_size=100000, chunksize=10000, progress=True) -> iTokCorpus:
+def preload_tokenizer(lang: Lang, tokenizer="", model="") -> None:
+    """
+    Loads the tokenizer used by en_tok()/is_tok(), e.g. in a worker process before it receives any lines.
+    """
+    if tokenizer == 'bpe':
+        _lazy_load_bpe_tokenizer(lang, model)
+    elif lang == 'en' or tokenizer == 'moses':
+        _lazy_load_moses_tokenizer(lang)
+
+
+def tokenize(corpus: iCorpus, lang: Lang, tokenizer="", model="", threads=1, chunksize=10000, progress=True) -> iTokCorpus:
     if lang == 'en':
         f = partial(en_tok, tokenizer=tokenizer, model=model)
     elif lang == 'is':
@@ -219,18 +402,11 @@ def tokenize(corpus: iCorpus, lang: Lang, tokenizer="", model="", threads=1, bat
     else:
         raise ValueError(f'Unknown language={lang}')
 
-    if threads == 1:
-        if progress:
-            corpus = tqdm(corpus)
-        for line in corpus:
-            yield f(line)
-    else:
-        with ProcessPoolExecutor(max_workers=threads) as worker:
-            for chunk in file_handler.make_batches(corpus, batch_size=batch_size):
-                chunk = list(chunk)
-                results = tqdm(worker.map(f, chunk, chunksize=chunksize), total=len(chunk))
-                for result in results:
-                    yield result
+    with tqdm(disable=not progress) as bar:
+        for results in file_handler.parallel_map(partial(file_handler.map_chunk, f), corpus, threads=threads, chunksize=chunksize,
+                                                 initializer=preload_tokenizer, initargs=(lang, tokenizer, model)):
+            bar.update(len(results))
+            yield from results
 
 
 def detokenize(corpus: iCorpus, lang: Lang, tokenizer=str, model=str, progress=True) -> iCorpus:
@@ -278,20 +454,47 @@ def split(corpus: Corpus, test_size=2000, shuffle=True, seed=42) -> Tuple[Corpus
     return train_test_split(corpus, shuffle=shuffle, test_size=test_size, random_state=seed)
 
 
-def train_truecase(corpus: iCorpus, save_to: str, threads=1) -> None:
-    truecaser = MosesTruecaser()
-    # Testing loading data beforehand.
-    data = [line.split(' ') for line in corpus]
-    truecaser.train(data, save_to=save_to, possibly_use_first_token=True, processes=threads, progress_bar=True)
+def choose_test_lines(total: int, test_size=2000, shuffle=True, seed=42) -> Set[int]:
+    """
+    Chooses the line numbers of the test set, without reading the corpus. The same seed gives the same lines.
+
+    :param total: The number of lines in the corpus.\n
+    :param test_size: The number of test lines.\n
+    :param shuffle: If False the last test_size lines are used, like split().\n
+    :param seed: The random seed.\n
+    :return: The line numbers, starting from 0.
+    """
+    if test_size > total:
+        raise ValueError(f'test_size={test_size} is larger than the corpus, lines={total}')
+    if shuffle:
+        return set(random.Random(seed).sample(range(total), test_size))
+    return set(range(total - test_size, total))
+
+
+def split_lines(corpora: Sequence[iCorpus], test_lines: Set[int]) -> Iterable[Tuple[bool, Tuple[str, ...]]]:
+    """
+    Streams the lines of the corpus, or of aligned parallel corpora, and marks the test lines, see choose_test_lines().
+
+    :return: Whether the lines are test lines and the lines, one per corpus.
+    """
+    for line_number, lines in enumerate(zip(*corpora)):
+        yield line_number in test_lines, lines
+
+
+def train_truecase(corpus: iCorpus, save_to: str, threads=1, chunksize=10000) -> None:
+    """
+    Trains a Moses truecase model on a tokenized corpus, see truecaser.train().
+    """
+    p_truecaser.train(corpus, save_to=save_to, threads=threads, chunksize=chunksize, possibly_use_first_token=True)
 
 
 def truecase(corpus: iCorpus, load_from: str) -> iCorpus:
     """
     Input needs to be tokenized and provided as a list of sentences.
     """
-    truecaser = _lazy_load_moses_truecaser(load_from=load_from)
+    truecaser = _lazy_load_truecaser(load_from=load_from)
     for line in corpus:
-        yield truecaser.truecase(line, return_str=True)
+        yield truecaser.truecase(line)
 
 
 def detruecase(corpus: iCorpus) -> iCorpus:
@@ -324,54 +527,138 @@ def preprocess_line(line: str,
                     tokenizer: str,
                     truecase_model: str,
                     known_tokens: Set[str],
-                    use_kvistur=False) -> str:
+                    use_kvistur=False,
+                    kvistur_cache: Optional[str] = None) -> str:
+    return preprocess_lines([line], lang=lang, tokenizer=tokenizer, truecase_model=truecase_model, known_tokens=known_tokens,
+                            use_kvistur=use_kvistur, kvistur_cache=kvistur_cache)[0]
+
+
+def preprocess_lines(lines: List[str],
+                     lang: str,
+                     tokenizer: str,
+                     truecase_model: str,
+                     known_tokens: Set[str],
+                     use_kvistur=False,
+                     kvistur_cache: Optional[str] = None,
+                     pretokenized=False) -> List[str]:
+    """
+    Preprocesses a batch of lines. The models are looked up once per batch instead of once per line.
+    The compound splits of Kvistur are memoized, kvistur_cache is the file of the cache, see load_split_cache().
+    If pretokenized, the lines are the output of tokenize(), space separated tokens, and are not tokenized again.
+    """
     # Tokenize
     # Truecase
     # Put Moses placeholders
     # Find unkown tokens and substitute with binary split
-    tokenized = (" ".join(tokens) for tokens in tokenize([line], lang=lang, tokenizer=tokenizer, progress=False))
-    truecased = truecase(tokenized, load_from=truecase_model)
-    # Now a string
-    escaped = list(escape_moses_chars(truecased))[0]
+    if lang == 'en':
+        tok = partial(en_tok, tokenizer=tokenizer)
+    elif lang == 'is':
+        tok = partial(is_tok, tokenizer=tokenizer)
+    else:
+        raise ValueError(f'Unknown language={lang}')
+    truecaser = _lazy_load_truecaser(load_from=truecase_model)
+    # Now strings
+    if pretokenized:
+        tokenized = [line.rstrip('\n') for line in lines]
+    else:
+        tokenized = [" ".join(tok(line)) for line in lines]
+    escaped = [escape_line(truecaser.truecase(line)) for line in tokenized]
     # If Kvistur is to be used it needs to be available on PYTHONPATH
     # We only use Kvistur on unknown Icelandic tokens, specify known tokens.
     if use_kvistur and known_tokens is not None and len(known_tokens) != 0 and lang == 'is':
-        # We go through the unkown tokens in the line, split on white-space since text is tokenized.
-        tokens = [tok.strip() for tok in escaped.split(' ')]
-        processed_tokens = []
-        for token in tokens:
-            # If it is not known
-            if token not in known_tokens:
-                # Either this does nothing, and the token is the same
-                # or the token is split s.t. "x_y" -> "x y"
-                token = re.sub("_", " ", _lazy_load_kvistur().re_split(token))
-            # We only split each token once.
-            processed_tokens.append(token)
-        return " ".join(processed_tokens)
-
+        cache = load_split_cache(kvistur_cache)
+        return [_split_unknown_tokens(line, known_tokens, cache) for line in escaped]
     else:
         return escaped
 
 
-def preprocess(corpus: iCorpus, lang: str, tokenizer: str, truecase_model: str, known_tokens: Set[str], threads=1, batch_size=500000, chunksize=10000) -> iCorpus:
-    f = partial(preprocess_line, lang=lang, tokenizer=tokenizer, truecase_model=truecase_model, known_tokens=known_tokens)
+def _split_unknown_tokens(line: str, known_tokens: Set[str], cache: CompoundSplitCache) -> str:
+    # We go through the unkown tokens in the line, split on white-space since text is tokenized.
+    tokens = [tok.strip() for tok in line.split(' ')]
+    processed_tokens = []
+    for token in tokens:
+        # If it is not known
+        if token not in known_tokens:
+            # Either this does nothing, and the token is the same
+            # or the token is split s.t. "x_y" -> "x y"
+            token = split_compound(token, cache)
+        # We only split each token once.
+        processed_tokens.append(token)
+    return " ".join(processed_tokens)
+
+
+def preload(lang: str, tokenizer: str, truecase_model: str, use_kvistur=False, kvistur_cache: Optional[str] = None, pretokenized=False,
+            **kwargs) -> None:
+    """
+    Loads the models used by preprocess_lines(), e.g. in a worker process before it receives any lines.
+    """
+    if not pretokenized:
+        preload_tokenizer(lang, tokenizer)
+    _lazy_load_truecaser(truecase_model)
+    if use_kvistur and lang == 'is':
+        load_split_cache(kvistur_cache)
+        _lazy_load_kvistur()
+
+
+_worker_kwargs: Dict[str, Any] = dict()
+"""The arguments of preprocess_lines() in a preprocess worker, set once by _init_preprocess_worker()."""
+
+
+def _init_preprocess_worker(kwargs: Dict[str, Any]) -> None:
+    # The known tokens are sent once per worker (or inherited when forked), instead of with every batch.
+    global _worker_kwargs
+    _worker_kwargs = kwargs
+    preload(**kwargs)
+
+
+def _preprocess_batch(lines: List[str]) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Runs preprocess_lines() in a worker and returns the new compound splits of the worker along with the lines.
+    """
+    return preprocess_lines(lines, **_worker_kwargs), load_split_cache(_worker_kwargs['kvistur_cache']).delta()
+
+
+def preprocess(corpus: iCorpus,
+               lang: str,
+               tokenizer: str,
+               truecase_model: str,
+               known_tokens: Set[str],
+               threads=1,
+               chunksize=10000,
+               use_kvistur=False,
+               kvistur_cache: Optional[str] = None,
+               pretokenized=False) -> iCorpus:
+    """
+    Preprocesses the corpus in batches of chunksize lines, see preprocess_lines().
+    A corpus which has already been tokenized, e.g. to train the truecase model, is not tokenized again if pretokenized.
+    With multiple threads the batches are processed in order on a bounded number of workers, see file_handler.parallel_map().
+    The workers load the models and receive the known tokens once, the batches only carry the lines.
+    The compound splits found by the workers are merged and saved to kvistur_cache, if set.
+    """
+    kwargs = dict(lang=lang, tokenizer=tokenizer, truecase_model=truecase_model, known_tokens=known_tokens, use_kvistur=use_kvistur,
+                  kvistur_cache=kvistur_cache, pretokenized=pretokenized)
+    cache = load_split_cache(kvistur_cache)
     if threads == 1:
-        for line in tqdm(corpus):
-            yield f(line)
-    else:
-        with ProcessPoolExecutor(max_workers=threads) as worker:
-            for chunk in file_handler.make_batches(corpus, batch_size=batch_size):
-                chunk = list(chunk)
-                results = tqdm(worker.map(f, chunk, chunksize=chunksize), total=len(chunk))
-                for result in results:
-                    yield result
+        _init_preprocess_worker(kwargs)
+    with tqdm() as progress:
+        for results, delta in file_handler.parallel_map(_preprocess_batch, corpus, threads=threads, chunksize=chunksize,
+                                                        initializer=_init_preprocess_worker, initargs=(kwargs,)):
+            # With a single thread the batches use this cache directly.
+            if threads != 1:
+                cache.merge(delta)
+            progress.update(len(results))
+            yield from results
+    if use_kvistur:
+        log.info(f'Compound split cache: {cache.stats()}')
+        if kvistur_cache is not None:
+            cache.save()
 
 
 def postprocess(corpus: Corpus, lang: str, tokenizer: str) -> Corpus:
     # Remove Moses placeholders
     # Detruecase
     # Detokenize
-    de_escaped = de_escape_moses_chars((line for line in corpus))
+    de_escaped = (de_escape_line(line) for line in corpus)
     detruecased = detruecase(de_escaped)
     detokenized = detokenize(detruecased, lang=lang, tokenizer=tokenizer)
     return list(detokenized)
@@ -1,13 +1,16 @@
 """A server front-end to an MT system. A RESTful interface. Implements a translation interface to Moses.
 """
+from typing import Iterator, Tuple
+import json
 import logging
 import uuid
 
-from flask import Flask
+from flask import Flask, Response
 from flask_cors import CORS
-from flask_restful import Resource, Api, reqparse
+from flask_restful import Resource, Api, reqparse, inputs
 
 from preprocessing import api as a
+from preprocessing import metrics
 
 log = logging.getLogger('frontend.server')
 app = Flask(__name__)
@@ -37,6 +40,12 @@ parser.add_argument('model',
                     required=True,
                     location='json',
                     help='The model to use to translate.', )
+parser.add_argument('useCache',
+                    type=inputs.boolean,
+                    required=False,
+                    default=True,
+                    location='json',
+                    help='Set to false to bypass the translation cache.', )
 
 
 class Ping(Resource):
@@ -51,6 +60,19 @@ class Ping(Resource):
         """
 
 
+class Metrics(Resource):
+    """The metrics of the translation server in the Prometheus text format.
+
+    :param path: /metrics \n
+    """
+    def get(self):
+        """
+        :param method: GET\n
+        :return: The metrics.
+        """
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 class MosesTranslate(Resource):
     """The translation endpoint. Accepts a list of sentences to translate and returns the results.
 
@@ -66,7 +88,8 @@ class MosesTranslate(Resource):
                 "contents": ["Sentence to translate"],
                 "sourceLanguageCode": "en"/"is",
                 "targetLanguageCode": "en"/"is",
-                "model": "The model to use. The model value must have a corresponding key in api.py s.t. 'source-target-model' exists"
+                "model": "The model to use. The model value must have a corresponding key in api.py s.t. 'source-target-model' exists",
+                "useCache": true/false (optional, defaults to true)
             }
         :param returns:\n
             {
@@ -84,6 +107,7 @@ class MosesTranslate(Resource):
         source_lang = args['sourceLanguageCode']
         target_lang = args['targetLanguageCode']
         model = args['model']
+        use_cache = args['useCache']
         id = uuid.uuid4().hex
         log.info(f"""Received translation request id={id}:
     contents={sentences}
@@ -93,7 +117,7 @@ class MosesTranslate(Resource):
         # We construct the model string so it fits what the api expects.
         model = "-".join([source_lang, target_lang, model])
         log.info(f"Parsed model string to model={model}")
-        translated_sentences = a.translate_bulk(sentences, s_lang=source_lang, t_lang=target_lang, model=model, id=id)
+        translated_sentences = a.translate_bulk(sentences, s_lang=source_lang, t_lang=target_lang, model=model, id=id, use_cache=use_cache)
         log.info(f"Sending translation response id={id}")
 
         return {
@@ -107,8 +131,60 @@ class MosesTranslate(Resource):
         }
 
 
+class MosesTranslateStream(Resource):
+    """The streaming translation endpoint. Accepts the same payload as /translateText and streams each translation
+    as a line of JSON (NDJSON) as soon as it is ready. The translations are in the order they finish.
+
+    :param path: /translateTextStream \n
+
+    """
+    def post(self):
+        """
+        :param method: POST \n
+        :param accepts: application/json \n
+        :param payload: See MosesTranslate.\n
+        :param returns: application/x-ndjson, a line per sentence\n
+            {"index": 0, "translatedText": "The translated text", "model": "The model used"}
+        :return:
+        """
+        args = parser.parse_args(strict=True)
+        sentences = args['contents']
+        source_lang = args['sourceLanguageCode']
+        target_lang = args['targetLanguageCode']
+        id = uuid.uuid4().hex
+        log.info(f"""Received streaming translation request id={id}:
+    contents={sentences}
+    sourceLanguageCode={source_lang}
+    targetLanguageCode={target_lang}
+    model={args['model']}""")
+        # We construct the model string so it fits what the api expects.
+        model = "-".join([source_lang, target_lang, args['model']])
+        # Errors which are known before the stream starts get an error status, like /translateText.
+        if model not in a.MODELS:
+            log.error(f"Unknown model={model} id={id}")
+            return {'message': f'Unknown model={model}'}, 500
+        translations = a.translate_stream(sentences, s_lang=source_lang, t_lang=target_lang, model=model, id=id, use_cache=args['useCache'])
+        return Response(stream_lines(translations, model, id), mimetype='application/x-ndjson')
+
+
+def stream_lines(translations: Iterator[Tuple[int, str]], model: str, id: str) -> Iterator[str]:
+    """
+    :return: A line of JSON per translation. If the translation fails, the status has been sent,
+    so a final error line tells the client that the stream is incomplete.
+    """
+    try:
+        for index, translation in translations:
+            yield json.dumps({'index': index, 'translatedText': translation, 'model': model}, ensure_ascii=False) + '\n'
+    except Exception as e:
+        log.exception(f"Streaming translation failed id={id}")
+        yield json.dumps({'error': a.describe_error(e)}) + '\n'
+
+
 api.add_resource(Ping, '/')
 api.add_resource(MosesTranslate, '/translateText')
+api.add_resource(MosesTranslateStream, '/translateTextStream')
+api.add_resource(Metrics, '/metrics')
 
 if __name__ == '__main__':
+    a.handle_signals()
     app.run(debug=True, host='0.0.0.0')
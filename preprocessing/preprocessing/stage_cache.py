@@ -0,0 +1,195 @@
+"""
+A content-addressed cache of the outputs of pipeline stages, i.e. main.py commands.
+
+The key of a stage is a hash of its command, the contents of the files and directories it reads (inputs, models and
+known tokens), and the code of this package. If the cache has outputs for the key the stage does not need to be run,
+the outputs are copied from the cache. The digests of files are remembered by path, size and modification time,
+so unchanged inputs are only hashed once.
+
+The cache directory contains "digests.json" and a directory per key with the outputs and a "stage.json" manifest.
+"""
+from typing import Any, Dict, List, Optional, Sequence
+from hashlib import blake2b
+import datetime
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+
+log = logging.getLogger()
+
+BLOCK_SIZE = 1 << 20
+PACKAGE_DIR = pathlib.Path(__file__).resolve().parent
+IGNORED_OPTIONS = {'--threads', '--chunksize', '--resume', '--checkpoint_interval'}
+"""Options which do not change the outputs of a command, and are not part of the key. Only --resume is a flag."""
+
+
+def _new_hash():
+    return blake2b(digest_size=32)
+
+
+def digest_file(path: str) -> str:
+    """
+    :return: The hex digest of the contents of the file.
+    """
+    digest = _new_hash()
+    with open(path, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_file(source: str, destination: str) -> str:
+    """
+    Copies the file and replaces the destination atomically.
+
+    :return: The hex digest of the contents of the file.
+    """
+    digest = _new_hash()
+    tmp_path = f'{destination}.tmp'
+    with open(source, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+        for block in iter(lambda: f_in.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            f_out.write(block)
+    os.replace(tmp_path, destination)
+    return digest.hexdigest()
+
+
+def source_digest() -> str:
+    """
+    :return: The hex digest of the code of this package and main.py, so a change in the code invalidates the cache.
+    """
+    digest = _new_hash()
+    for path in sorted(PACKAGE_DIR.glob('*.py')) + [PACKAGE_DIR.parent.joinpath('main.py')]:
+        if path.exists():
+            digest.update(path.name.encode('utf-8'))
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """The outputs of stages in a cache directory, see the module documentation."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._digests_path = os.path.join(directory, 'digests.json')
+        self._digests: Dict[str, List[Any]] = dict()
+        if os.path.exists(self._digests_path):
+            with open(self._digests_path, encoding='utf8') as f_in:
+                self._digests = json.load(f_in)
+
+    def _stat_key(self, path: str) -> List[Any]:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def digest(self, path: str) -> str:
+        """
+        :return: The hex digest of the contents of a file, or of the relative paths and contents of the files in a directory.
+        """
+        if os.path.isdir(path):
+            digest = _new_hash()
+            for directory, directories, files in os.walk(path):
+                directories.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(directory, name)
+                    digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                    digest.update(self.digest(file_path).encode('ascii'))
+            return digest.hexdigest()
+        path = os.path.abspath(path)
+        remembered = self._digests.get(path)
+        stat_key = self._stat_key(path)
+        if remembered is not None and remembered[:2] == stat_key:
+            return remembered[2]
+        value = digest_file(path)
+        self._digests[path] = stat_key + [value]
+        return value
+
+    def _remember(self, path: str, value: str) -> None:
+        path = os.path.abspath(path)
+        self._digests[path] = self._stat_key(path) + [value]
+
+    def save_digests(self) -> None:
+        tmp_path = f'{self._digests_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f_out:
+            json.dump(self._digests, f_out)
+        os.replace(tmp_path, self._digests_path)
+
+    def key(self, command: Sequence[str], outputs: Sequence[str], depends: Sequence[str] = ()) -> str:
+        """
+        :param command: The arguments of the main.py command. The arguments, or values of "--option=value" arguments,
+        which are existing files or directories are inputs and their contents are hashed. IGNORED_OPTIONS are skipped.\n
+        :param outputs: The files written by the command. Their contents are not hashed, only their position in the command.\n
+        :param depends: Other files or directories read by the command, e.g. a default model.\n
+        :return: The hex digest of the stage.
+        """
+        outputs = [os.path.abspath(output) for output in outputs]
+        digest = _new_hash()
+        digest.update(source_digest().encode('ascii'))
+        arguments = iter(command)
+        for argument in arguments:
+            if argument.split('=', 1)[0] in IGNORED_OPTIONS:
+                if argument != '--resume' and '=' not in argument:
+                    next(arguments, None)
+                continue
+            if argument == '-':
+                raise ValueError('The inputs and outputs of a stage need to be files, not stdin or stdout')
+            prefix, value = argument.split('=', 1) if argument.startswith('--') and '=' in argument else ('', argument)
+            if os.path.abspath(value) in outputs:
+                value = f'{{output {outputs.index(os.path.abspath(value))}}}'
+            elif os.path.exists(value):
+                value = f'{{input {self.digest(value)}}}'
+            digest.update(f'{prefix}={value}'.encode('utf-8') + b'\0')
+        for path in depends:
+            digest.update(f'{{depends {self.digest(path)}}}'.encode('utf-8') + b'\0')
+        self.save_digests()
+        return digest.hexdigest()
+
+    def _stage_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key: str, outputs: Sequence[str]) -> Optional[Dict[str, Any]]:
+        """
+        Copies the cached outputs of the stage to the outputs.
+
+        :return: The manifest of the cached stage, or None if the stage is not cached.
+        """
+        stage_dir = self._stage_dir(key)
+        manifest_path = os.path.join(stage_dir, 'stage.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, encoding='utf8') as f_in:
+            manifest = json.load(f_in)
+        for index, output in enumerate(outputs):
+            value = copy_file(os.path.join(stage_dir, f'output-{index}'), output)
+            self._remember(output, value)
+        self.save_digests()
+        return manifest
+
+    def store(self, key: str, outputs: Sequence[str], command: Sequence[str]) -> Dict[str, Any]:
+        """
+        Copies the outputs of a stage which has been run to the cache.
+
+        :return: The manifest of the stage.
+        """
+        stage_dir = self._stage_dir(key)
+        os.makedirs(os.path.dirname(stage_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f'{key}.', suffix='.tmp', dir=os.path.dirname(stage_dir))
+        manifest = dict(key=key, command=list(command), outputs=list(outputs), created=datetime.datetime.now().isoformat(timespec='seconds'))
+        try:
+            for index, output in enumerate(outputs):
+                value = copy_file(output, os.path.join(tmp_dir, f'output-{index}'))
+                self._remember(output, value)
+            with open(os.path.join(tmp_dir, 'stage.json'), 'w', encoding='utf8') as f_out:
+                json.dump(manifest, f_out)
+            try:
+                os.rename(tmp_dir, stage_dir)
+            except OSError:
+                # Another job has stored the same stage in the meantime, its outputs are the same.
+                log.info(f'Stage already cached, key={key}')
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.save_digests()
+        return manifest
@@ -0,0 +1,229 @@
+"""
+A fast truecaser which applies a Moses truecase model, e.g. resources/truecase-model.is, with the same output as
+sacremoses 0.0.38 (see requirements.txt) and Moses truecase.perl.
+
+The first word of a sentence is truecased to its most frequent form. Elsewhere, a form which is in the model is kept and
+other forms are truecased to the most frequent form. The model is loaded once into two tables which map every cased form
+in the model, and its lowercased form, directly to its truecased form, one for the first word and one for other words.
+Most tokens are then truecased with a single dictionary lookup.
+
+Models are trained with train(), which counts the casing of chunks of the corpus on multiple processes and merges the counts.
+"""
+from typing import Dict, List, Iterable
+from functools import partial
+import logging
+import os
+import re
+
+from sacremoses import MosesTruecaser
+from tqdm import tqdm
+
+log = logging.getLogger()
+
+XML_TAG = re.compile(r"(<\S[^>]*>)")
+XML_START = re.compile(r"^\s*(<\S[^>]*>)(.*)$")
+NON_XML_START = re.compile(r"^\s*([^\s<>]+)(.*)$")
+XML_COGNATE_START = re.compile(r"^\s*(\S+)(.*)$")
+FACTOR_START = re.compile(r"^(\|+)(.*)$")
+FACTORS = re.compile(r"^([^\|]+)(.*)")
+_MOSES = MosesTruecaser()
+LETTERS = _MOSES.SKIP_LETTERS_REGEX
+SENT_END = _MOSES.SENT_END
+DELAYED_SENT_START = _MOSES.DELAYED_SENT_START
+
+Casing = Dict[str, Dict[str, float]]
+"""The lowercased tokens and the weighted counts of their forms."""
+
+
+def load_best_casing(path: str) -> Dict[str, str]:
+    """
+    Reads a Moses truecase model; lines of "token (count/total)" pairs.
+
+    :param path: The truecase model.\n
+    :return: The lowercased tokens and their most frequent form. Ties go to the form seen first, like in sacremoses.
+    """
+    casing: Dict[str, Dict[str, int]] = dict()
+    with open(path, encoding='utf8') as f_in:
+        for line_number, line in enumerate(f_in, 1):
+            fields = line.split()
+            if len(fields) % 2 != 0:
+                raise ValueError(f'Malformed truecase model={path}, line={line_number} has an odd number of fields')
+            for token, count in zip(fields[::2], fields[1::2]):
+                casing.setdefault(token.lower(), dict())[token] = float(count.split('/')[0].strip('()'))
+    return {lower: max(forms.items(), key=lambda form: form[1])[0] for lower, forms in casing.items()}
+
+
+def split_xml(line: str) -> List[str]:
+    """
+    Splits a line into tokens and XML tags, like split_xml() in Moses truecase.perl. A "<" or ">" which is not a part of
+    an XML tag is split from the rest of the token, e.g. "a>b" is split into "a" and ">b".
+    """
+    line = line.strip()
+    tokens: List[str] = []
+    while line:
+        has_xml = XML_START.search(line)
+        is_non_xml = NON_XML_START.search(line)
+        if has_xml:
+            potential_xml, line_next = has_xml.groups()
+            if not line[0].isspace() and len(tokens) > 0 and tokens[-1].endswith('|'):
+                # A factor which is an XML tag, it is joined with the previous token, as are the following factors.
+                tokens[-1] += potential_xml
+                is_factor = FACTOR_START.search(line_next)
+                if is_factor:
+                    tokens[-1] += is_factor.group(1)
+                    line_next = is_factor.group(2)
+            else:
+                tokens.append(potential_xml)
+            line = line_next
+        elif is_non_xml:
+            token, line = is_non_xml.groups()
+            tokens.append(token)
+        else:
+            token, line = XML_COGNATE_START.search(line).groups()
+            tokens.append(token)
+    return tokens
+
+
+class Truecaser:
+    """Truecases tokenized lines with a Moses truecase model, see the module documentation."""
+
+    def __init__(self, path: str):
+        """
+        :param path: The truecase model.
+        """
+        self.path = path
+        self.best = load_best_casing(path)
+        # The cased forms in the model do not need to be lowercased before the lookup.
+        self.first_table = dict(self.best)
+        self.table = dict(self.best)
+        with open(path, encoding='utf8') as f_in:
+            for line in f_in:
+                for token in line.split()[::2]:
+                    self.first_table[token] = self.best[token.lower()]
+                    # A known form is not changed, unless it is the first word of a sentence.
+                    self.table[token] = token
+        log.info(f'Loaded truecase model={path}, len={len(self.best)}')
+
+    def truecase_token(self, token: str, is_first_word=False) -> str:
+        best = (self.first_table if is_first_word else self.table).get(token)
+        if best is not None:
+            return best
+        return self.best.get(token.lower(), token)
+
+    def truecase(self, line: str) -> str:
+        """
+        Truecases a line of space separated tokens. Equivalent to MosesTruecaser.truecase(line, return_str=True) of
+        sacremoses 0.0.38. A word which follows one of SENT_END is the first word of a sentence.
+        """
+        if '<' in line or '>' in line or '|' in line:
+            return " ".join(self._truecase_xml(line))
+        first_table, table, best = self.first_table, self.table, self.best
+        tokens = []
+        is_first_word = True
+        for token in line.split():
+            truecased = (first_table if is_first_word else table).get(token)
+            if truecased is None:
+                truecased = best.get(token.lower(), token)
+            tokens.append(truecased)
+            is_first_word = truecased in SENT_END
+        return " ".join(tokens)
+
+    def _truecase_xml(self, line: str) -> List[str]:
+        # XML tags and factors follow the same rules as sacremoses, they do not change the start of a sentence.
+        tokens = []
+        is_first_word = True
+        for token in split_xml(line):
+            if XML_TAG.search(token) or token.startswith('|'):
+                tokens.append(token)
+                continue
+            token, other_factors = FACTORS.search(token).groups()
+            tokens.append(self.truecase_token(token, is_first_word) + other_factors)
+            is_first_word = tokens[-1] in SENT_END
+        return tokens
+
+
+def count_casing(lines: List[str], possibly_use_first_token=True) -> Casing:
+    """
+    Counts the casing of the tokens in tokenized lines, like MosesTruecaser.learn_truecase_weights().
+
+    :param lines: Lines of space separated tokens.\n
+    :param possibly_use_first_token: Count the first token of a sentence if it is lowercase. If it is the only token of the line
+    it is counted with the weight 0.1.\n
+    :return: The counts.
+    """
+    casing: Casing = dict()
+    for line in lines:
+        is_first_word = True
+        for index, token in enumerate(line.split()):
+            if XML_TAG.search(token) or token in DELAYED_SENT_START:
+                continue
+            if not is_first_word and token in SENT_END:
+                is_first_word = True
+                continue
+            if not LETTERS.search(token):
+                is_first_word = False
+                continue
+            weight = 0.0
+            if not is_first_word:
+                weight = 1
+            elif possibly_use_first_token:
+                if token[0].islower():
+                    weight = 1
+                elif index == 1:
+                    weight = 0.1
+            is_first_word = False
+            if weight > 0:
+                forms = casing.setdefault(token.lower(), dict())
+                forms[token] = forms.get(token, 0) + weight
+    return casing
+
+
+def merge_casing(total: Casing, casing: Casing) -> None:
+    """Adds the counts of casing to total."""
+    for lower, forms in casing.items():
+        total_forms = total.setdefault(lower, dict())
+        for token, count in forms.items():
+            total_forms[token] = total_forms.get(token, 0) + count
+
+
+def _format_count(count: float) -> str:
+    return str(int(count)) if count == int(count) else f'{count:.1f}'
+
+
+def write_model(casing: Casing, path: str) -> None:
+    """
+    Writes the counts as a Moses truecase model, "token (count/total) other (count)" per line, most frequent form first.
+    The file is replaced atomically.
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f_out:
+        for forms in casing.values():
+            ordered = sorted(forms.items(), key=lambda form: form[1], reverse=True)
+            best, count = ordered[0]
+            fields = [f'{best} ({_format_count(count)}/{_format_count(sum(forms.values()))})']
+            fields.extend(f'{token} ({_format_count(count)})' for token, count in ordered[1:])
+            f_out.write(" ".join(fields) + "\n")
+    os.replace(tmp_path, path)
+
+
+def train(corpus: Iterable[str], save_to: str, threads=1, chunksize=10000, possibly_use_first_token=True) -> Casing:
+    """
+    Trains a Moses truecase model on a tokenized corpus. The casing of chunks of the corpus is counted on threads processes
+    and merged, so the memory used depends on the size of the vocabulary but not on the size of the corpus.
+
+    :param corpus: Lines of space separated tokens.\n
+    :param save_to: The file to write the model to.\n
+    :param threads: The number of processes.\n
+    :param chunksize: The number of lines counted by a process at a time.\n
+    :param possibly_use_first_token: See count_casing().\n
+    :return: The counts.
+    """
+    # file_handler imports the pipeline, which imports this module.
+    from preprocessing import file_handler
+    casing: Casing = dict()
+    f = partial(count_casing, possibly_use_first_token=possibly_use_first_token)
+    for counts in tqdm(file_handler.parallel_map(f, corpus, threads=threads, chunksize=chunksize)):
+        merge_casing(casing, counts)
+    write_model(casing, save_to)
+    log.info(f'Wrote truecase model={save_to}, len={len(casing)}')
+    return casing
@@ -0,0 +1,95 @@
+"""
+Token frequencies of tokenized corpora, counted in parallel.
+
+The corpus is counted in chunks on multiple processes and the counts are merged. A vocabulary is written sorted by frequency,
+a token and its count per line separated by a tab. It can be built into a TokenSet with "main.py build-token-set",
+which is then used to find the unknown tokens of a corpus.
+"""
+from typing import Iterable, Iterator, List, Tuple, Optional, Union, Set, TextIO, Counter as CounterType
+from collections import Counter
+import logging
+
+from tqdm import tqdm
+
+from preprocessing import file_handler
+from preprocessing.known_tokens import TokenSet
+
+log = logging.getLogger()
+
+KnownTokens = Union[Set[str], TokenSet]
+
+
+def count_tokens(lines: List[str]) -> CounterType[str]:
+    """
+    :param lines: Lines of space separated tokens.\n
+    :return: The number of occurrences of each token.
+    """
+    counts: CounterType[str] = Counter()
+    for line in lines:
+        counts.update(tok for tok in line.strip().split(' ') if tok != '')
+    return counts
+
+
+def count_vocabulary(corpus: Iterable[str], threads=1, chunksize=10000) -> CounterType[str]:
+    """
+    Counts the tokens of a tokenized corpus on threads processes, see file_handler.parallel_map().
+
+    :return: The number of occurrences of each token.
+    """
+    counts: CounterType[str] = Counter()
+    for chunk_counts in tqdm(file_handler.parallel_map(count_tokens, corpus, threads=threads, chunksize=chunksize)):
+        counts.update(chunk_counts)
+    log.info(f'Counted tokens={sum(counts.values())}, unique={len(counts)}')
+    return counts
+
+
+def sorted_vocabulary(counts: CounterType[str], min_count=1) -> List[Tuple[str, int]]:
+    """
+    :return: The tokens which occur at least min_count times and their counts, the most frequent first and then alphabetically.
+    """
+    return sorted(((token, count) for token, count in counts.items() if count >= min_count), key=lambda item: (-item[1], item[0]))
+
+
+def write_vocabulary(vocabulary: Iterable[Tuple[str, int]], f_out: TextIO, with_counts=True) -> None:
+    for token, count in vocabulary:
+        f_out.write(f'{token}\t{count}\n' if with_counts else f'{token}\n')
+
+
+def read_vocabulary(f_in: Iterable[str]) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Reads a vocabulary written by write_vocabulary(). The count is None for lines with only a token.
+    """
+    for line in f_in:
+        fields = line.rstrip('\n').split('\t')
+        if fields[0].strip() == '':
+            continue
+        yield fields[0], int(fields[1]) if len(fields) > 1 else None
+
+
+_known: KnownTokens = set()
+"""The known tokens of an unknown_tokens() worker, set once by _init_known()."""
+
+
+def _init_known(known: KnownTokens) -> None:
+    global _known
+    _known = known
+
+
+def _count_unknown(lines: List[str]) -> CounterType[str]:
+    return Counter({token: count for token, count in count_tokens(lines).items() if token not in _known})
+
+
+def count_unknown_tokens(corpus: Iterable[str], known: KnownTokens, threads=1, chunksize=10000) -> CounterType[str]:
+    """
+    Counts the tokens of a tokenized corpus which are not known. A TokenSet is memory-mapped by the workers, a set is
+    sent to each worker once.
+
+    :return: The number of occurrences of each unknown token.
+    """
+    _init_known(known)
+    counts: CounterType[str] = Counter()
+    for chunk_counts in tqdm(file_handler.parallel_map(_count_unknown, corpus, threads=threads, chunksize=chunksize,
+                                                       initializer=_init_known, initargs=(known,))):
+        counts.update(chunk_counts)
+    log.info(f'Unknown tokens={sum(counts.values())}, unique={len(counts)}')
+    return counts
@@ -0,0 +1,39 @@
+"""Compares escaping with one re.sub per illegal character against escape_line/de_escape_line."""
+import random
+from time import time
+
+from preprocessing import pipeline
+
+lines = 200000
+tokens_per_line = 25
+
+
+def escape_per_character(sent):
+    for keywords in pipeline.illegal_replace:
+        sent = keywords['pattern'].sub(string=sent, repl=keywords['repl'].pattern)
+    return sent
+
+
+def de_escape_per_character(sent):
+    for keywords in pipeline.illegal_replace:
+        sent = keywords['repl'].sub(string=sent, repl=keywords['unicode'])
+    return sent
+
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    plain = ['hús', 'bátur', 'og', 'the', 'a', '.', ',']
+    special = ['|', '<', '>', '[', ']', 'x|y']
+    # Most lines of a real corpus do not contain any of the escaped characters.
+    for density, words in [('sparse', plain * 40 + special), ('dense', plain + special)]:
+        corpus = [' '.join(rng.choice(words) for _ in range(tokens_per_line)) for _ in range(lines)]
+        for name, escape, de_escape in [('per character', escape_per_character, de_escape_per_character),
+                                        ('escape_line', pipeline.escape_line, pipeline.de_escape_line)]:
+            start = time()
+            escaped = [escape(line) for line in corpus]
+            escape_took = time() - start
+            start = time()
+            de_escaped = [de_escape(line) for line in escaped]
+            de_escape_took = time() - start
+            assert de_escaped == corpus
+            print(f'{density} {name}: escape lines/s={lines / escape_took:.0f}, de-escape lines/s={lines / de_escape_took:.0f}')
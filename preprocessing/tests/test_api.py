@@ -1,8 +1,236 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import signal
+
+import pytest
+from aiohttp_xmlrpc.client import ServerProxy
+
 from preprocessing import api
+from preprocessing import pipeline
+from conftest import StubMoses, PinnedServerProxy
+
+
+def run_engine(use, models, **kwargs):
+    """
+    Creates a TranslationEngine with the models and kwargs on a new event loop, awaits use(engine) and closes the engine.
+
+    :return: The result of use(engine).
+    """
+    async def run():
+        engine = api.TranslationEngine(models, **kwargs)
+        try:
+            return await use(engine)
+        finally:
+            await engine.close()
+
+    return asyncio.run(run())
 
 
 def test_preprocess():
     test = 'Þetta er íslensk setning.'
     result = api.preprocess(test, lang='is')
     print(result)
-    assert test != result
\ No newline at end of file
+    assert test != result
+
+
+def test_translate_bulk_reuses_engine(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    try:
+        first = api.translate_bulk(['This is Haukur'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+        loop, engine = api.get_engine()
+        second = api.translate_bulk(['this is'], s_lang='en', t_lang='is', model='en-is-test', id='2')
+        assert api.get_engine() == (loop, engine)
+        assert first == ['This is Haukur']
+        assert second == ['This is']
+        assert moses_server.calls == ['this is Haukur', 'this is']
+    finally:
+        api.shutdown()
+    assert api._engine is None
+
+
+def test_shutdown_on_sigterm(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cache.json')
+    monkeypatch.setattr(api, 'CACHE_FILE', path)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        api.handle_signals()
+        _, engine = api.get_engine()
+        engine.cache.put(engine.cache.key('en-is', 'en', 'a'), 'b')
+        with pytest.raises(SystemExit) as exit_info:
+            os.kill(os.getpid(), signal.SIGTERM)
+        assert exit_info.value.code == 128 + signal.SIGTERM
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        api.shutdown()
+    assert api._engine is None
+    saved = api.TranslationCache(10, path=path)
+    saved.load()
+    assert saved.get(saved.key('en-is', 'en', 'a')) == 'b'
+
+
+@pytest.mark.parametrize('kind', ['inline', 'thread', 'process'])
+def test_engine_executors(kind, moses_server, truecase_model, monkeypatch):
+    # Spawned workers read the truecase model from the environment.
+    monkeypatch.setenv('TRUECASE_en', truecase_model)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def use(engine):
+        return await engine.translate_bulk(['This is Haukur', 'this'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+
+    assert run_engine(use, {'en-is-test': moses_server.url}, executor=api.make_executor(kind, workers=2)) == ['This is Haukur', 'This']
+
+
+def test_translation_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, 'time', lambda: 100.0)
+    cache = api.TranslationCache(max_size=2, ttl=10)
+    cache.put(cache.key('en-is', 'en', 'a  sentence '), 'setning')
+    cache.put(cache.key('en-is', 'en', 'b'), 'b')
+    assert cache.get(cache.key('en-is', 'en', ' a sentence')) == 'setning'
+    cache.put(cache.key('en-is', 'en', 'c'), 'c')
+    # "b" was the least recently used
+    assert cache.get(cache.key('en-is', 'en', 'b')) is None
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 1}
+
+    path = str(tmp_path / 'cache.json')
+    cache.save(path)
+    monkeypatch.setattr(api, 'time', lambda: 105.0)
+    warm = api.TranslationCache(max_size=2, ttl=10)
+    warm.load(path)
+    assert warm.get(warm.key('en-is', 'en', 'c')) == 'c'
+    monkeypatch.setattr(api, 'time', lambda: 111.0)
+    assert warm.get(warm.key('en-is', 'en', 'c')) is None
+
+
+def test_engine_cache(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def use(engine):
+        first = await engine.translate_bulk(['This is Haukur'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+        cached = await engine.translate_bulk(['This  is Haukur'], s_lang='en', t_lang='is', model='en-is-test', id='2')
+        bypassed = await engine.translate_bulk(['This is Haukur'], s_lang='en', t_lang='is', model='en-is-test', id='3', use_cache=False)
+        return first, cached, bypassed
+
+    result = run_engine(use, {'en-is-test': moses_server.url}, cache=api.TranslationCache(max_size=10))
+    assert result == (['This is Haukur'], ['This is Haukur'], ['This is Haukur'])
+    assert len(moses_server.calls) == 2
+
+
+def test_engine_coalesces_translations(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    moses_server.delay = 0.1
+
+    async def use(engine):
+        return await asyncio.gather(
+            engine.translate_bulk(['this is', 'Haukur', 'this is'], s_lang='en', t_lang='is', model='en-is-test', id='1'),
+            engine.translate_bulk(['This is'], s_lang='en', t_lang='is', model='en-is-test', id='2'))
+
+    assert run_engine(use, {'en-is-test': moses_server.url}) == [['This is', 'Haukur', 'This is'], ['This is']]
+    assert sorted(moses_server.calls) == ['Haukur', 'this is']
+
+
+def test_engine_routes_to_least_loaded_replica(start_moses, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    replicas = [start_moses(delay=0.1), start_moses(delay=0.1)]
+
+    async def use(engine):
+        return await engine.translate_bulk(['a', 'b', 'c', 'd'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+
+    assert run_engine(use, {'en-is-test': ','.join(replica.url for replica in replicas)}) == ['A', 'B', 'C', 'D']
+    assert [len(replica.calls) for replica in replicas] == [2, 2]
+
+
+@pytest.mark.parametrize('proxy', [ServerProxy, PinnedServerProxy])
+def test_engine_ejects_and_restores_replica(proxy, moses_server, start_moses, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    monkeypatch.setattr(api, 'ServerProxy', proxy)
+    # Nothing listens on the port of the replica until it is restarted.
+    down = StubMoses()
+    down.server.server_close()
+
+    async def use(engine):
+        translated = await engine.translate_bulk(['a', 'b'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+        replica = engine.get_client('en-is-test').replicas[0]
+        ejected = not replica.healthy
+        start_moses(port=down.server.server_address[1])
+        await asyncio.sleep(0.3)
+        return translated, ejected, replica.healthy
+
+    models = {'en-is-test': f'{down.url},{moses_server.url}'}
+    assert run_engine(use, models, max_failures=1, probe_interval=0.05) == (['A', 'B'], True, True)
+    assert sorted(moses_server.calls) == ['a', 'b']
+
+
+def test_engine_without_replicas(truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def use(engine):
+        return await engine.translate_bulk(['a'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+
+    with pytest.raises(ValueError, match='No Moses replicas'):
+        run_engine(use, {'en-is-test': ''})
+
+
+@pytest.mark.parametrize('proxy', [ServerProxy, PinnedServerProxy])
+def test_engine_batches_moses_calls(proxy, moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    monkeypatch.setattr(api, 'ServerProxy', proxy)
+    multicalls = []
+    moses_server.server.register_function(lambda calls: multicalls.append(len(calls)) or moses_server.server.system_multicall(calls),
+                                          'system.multicall')
+
+    async def use(engine):
+        return await asyncio.gather(
+            engine.translate_bulk(['a', 'b'], s_lang='en', t_lang='is', model='en-is-test', id='1'),
+            engine.translate_bulk(['c', 'd'], s_lang='en', t_lang='is', model='en-is-test', id='2'))
+
+    assert run_engine(use, {'en-is-test': moses_server.url}, batch_size=3, batch_window=0.05) == [['A', 'B'], ['C', 'D']]
+    assert sorted(moses_server.calls) == ['a', 'b', 'c', 'd']
+    assert sorted(multicalls) == [1, 3]
+
+
+def test_engine_preprocesses_in_batches(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    batches = []
+    preprocess_bulk = api.preprocess_bulk
+
+    def record(sents, lang):
+        batches.append(list(sents))
+        return preprocess_bulk(sents, lang)
+
+    monkeypatch.setattr(api, 'preprocess_bulk', record)
+
+    async def use(engine):
+        return await engine.translate_bulk(['This', 'is', 'Haukur', 'This'], s_lang='en', t_lang='is', model='en-is-test', id='1')
+
+    assert run_engine(use, {'en-is-test': moses_server.url}, workers=2) == ['This', 'Is', 'Haukur', 'This']
+    assert batches == [['This', 'is'], ['Haukur']]
+
+
+def test_engine_merges_worker_splits(moses_server, truecase_model, tmp_path, monkeypatch):
+    class Kvistur:
+        def re_split(self, token):
+            return token[:3] + '_' + token[3:]
+
+    path = str(tmp_path / 'splits.json')
+    monkeypatch.setattr(pipeline, '_lazy_load_kvistur', lambda: Kvistur())
+    monkeypatch.setattr(pipeline, 'lazy_objects', dict())
+    monkeypatch.setattr(api, 'USE_KVISTUR', True)
+    monkeypatch.setattr(api, 'KVISTUR_CACHE_FILE', path)
+    monkeypatch.setitem(api.TRUECASERS, 'is', truecase_model)
+    monkeypatch.setitem(api.TOKENS, 'is', {'this', 'is'})
+
+    async def use(engine):
+        return await engine.translate_bulk(['this is Haukur', 'Haukur is this'], s_lang='is', t_lang='en', model='is-en-test', id='1')
+
+    # Forked, so the workers use the fake Kvistur.
+    executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('fork'))
+    run_engine(use, {'is-en-test': moses_server.url}, executor=executor, workers=2)
+    assert sorted(moses_server.calls) == ['Hau kur is this', 'this is Hau kur']
+    assert pipeline.load_split_cache(path).stats()['size'] == 1
+    saved = pipeline.CompoundSplitCache(path=path)
+    saved.load()
+    assert saved.get('Haukur') == 'Hau kur'
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestServer, TestClient
+
+from preprocessing import api
+from preprocessing import async_server
+
+
+def test_parse_args():
+    payload = {'contents': ['Halló'], 'sourceLanguageCode': 'is', 'targetLanguageCode': 'en', 'model': 'moses'}
+    args, error = async_server.parse_args(payload)
+    assert error is None
+    assert args['useCache'] is True
+    _, error = async_server.parse_args({**payload, 'sourceLanguageCode': 'de'})
+    assert error == {'message': {'sourceLanguageCode': 'The language code of the sentences.'}}
+    _, error = async_server.parse_args({**payload, 'extra': 1})
+    assert error == {'message': 'Unknown arguments: extra'}
+    args, _ = async_server.parse_args({**payload, 'useCache': 'false'})
+    assert args['useCache'] is False
+
+
+def test_translate_text(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def run():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            ping = await client.get('/')
+            response = await client.post('/translateText', json={
+                'contents': ['This is Haukur', 'this'],
+                'sourceLanguageCode': 'en',
+                'targetLanguageCode': 'is',
+                'model': 'test'
+            })
+            invalid = await client.post('/translateText', json={'contents': []})
+            metrics = await client.get('/metrics')
+            return ping.status, await response.json(), invalid.status, await metrics.text()
+
+    ping, response, invalid, metrics = asyncio.run(run())
+    assert ping == 200
+    assert response == {'translations': [{'translatedText': 'This is Haukur', 'model': 'en-is-test'},
+                                         {'translatedText': 'This', 'model': 'en-is-test'}]}
+    assert invalid == 400
+    assert 'translation_moses_seconds_count{model="en-is-test"}' in metrics
+
+
+def test_translate_text_stream(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def run():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            response = await client.post('/translateTextStream', json={
+                'contents': ['This is Haukur', 'this', 'this'],
+                'sourceLanguageCode': 'en',
+                'targetLanguageCode': 'is',
+                'model': 'test'
+            })
+            return response.headers['Content-Type'], [json.loads(line) async for line in response.content]
+
+    content_type, lines = asyncio.run(run())
+    assert content_type == 'application/x-ndjson'
+    assert sorted(lines, key=lambda line: line['index']) == [
+        {'index': 0, 'translatedText': 'This is Haukur', 'model': 'en-is-test'},
+        {'index': 1, 'translatedText': 'This', 'model': 'en-is-test'},
+        {'index': 2, 'translatedText': 'This', 'model': 'en-is-test'}]
+
+
+def test_translate_text_stream_errors(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def timing_out(self, sentences, *args, **kwargs):
+        yield 0, sentences[0]
+        raise asyncio.TimeoutError()
+
+    payload = {'contents': ['this', 'that'], 'sourceLanguageCode': 'en', 'targetLanguageCode': 'is', 'model': 'test'}
+
+    async def run():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            unknown = await client.post('/translateTextStream', json={**payload, 'model': 'unknown'})
+            monkeypatch.setattr(api.TranslationEngine, 'translate_stream', timing_out)
+            response = await client.post('/translateTextStream', json=payload)
+            return unknown.status, response.status, [json.loads(line) async for line in response.content]
+
+    unknown, status, lines = asyncio.run(run())
+    assert unknown == 500
+    assert status == 200
+    assert lines == [{'index': 0, 'translatedText': 'this', 'model': 'en-is-test'}, {'error': 'Translation timed out'}]
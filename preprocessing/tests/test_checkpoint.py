@@ -0,0 +1,43 @@
+import itertools
+
+import pytest
+
+from preprocessing import checkpoint
+
+
+def run(corpus, output, resume=False, fail_at=None):
+    with checkpoint.CheckpointedOutput(output, dict(command='test'), resume=resume, interval=0.0) as f_out:
+        for line in itertools.islice(corpus, f_out.done, None):
+            if line == fail_at:
+                raise RuntimeError('Killed')
+            f_out.write(line.upper())
+
+
+def test_resume(tmp_path):
+    corpus = [f'línа {number}\n' for number in range(100)]
+    expected, output = str(tmp_path / 'expected'), str(tmp_path / 'output')
+    run(corpus, expected)
+
+    with pytest.raises(RuntimeError):
+        run(corpus, output, fail_at=corpus[40])
+    state = checkpoint.load_checkpoint(checkpoint.checkpoint_path(output))
+    assert state['input_items'] == 40
+    # Output written after the last checkpoint is dropped.
+    with open(output, 'a') as f_out:
+        f_out.write('partial')
+    run(corpus, output, resume=True)
+
+    with open(expected, 'rb') as f_expected, open(output, 'rb') as f_output:
+        assert f_expected.read() == f_output.read()
+    assert checkpoint.load_checkpoint(checkpoint.checkpoint_path(output)) is None
+
+
+def test_resume_different_params(tmp_path):
+    output = str(tmp_path / 'output')
+    with pytest.raises(RuntimeError):
+        run(['a\n', 'b\n'], output, fail_at='b\n')
+    with pytest.raises(ValueError):
+        checkpoint.CheckpointedOutput(output, dict(command='other'), resume=True)
+    # Without --resume the output is started over.
+    run(['a\n', 'b\n'], output)
+    assert open(output).read() == 'A\nB\n'
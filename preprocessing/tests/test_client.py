@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+from preprocessing import api
+from preprocessing import client
+from preprocessing import server
+
+
+def test_translate_stream(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f'http://127.0.0.1:{http_server.server_port}/translateTextStream'
+        translations = list(client.translate_stream(['this is', 'Haukur', 'this is'], url=url, s_lang='en', t_lang='is', model='test', batch_size=2))
+    finally:
+        http_server.shutdown()
+        api.shutdown()
+    assert sorted(translations) == [(0, 'This is'), (1, 'Haukur'), (2, 'This is')]
+
+
+def test_translate_stream_errors(moses_server, truecase_model, monkeypatch):
+    monkeypatch.setitem(api.MODELS, 'en-is-test', moses_server.url)
+    monkeypatch.setitem(api.TRUECASERS, 'en', truecase_model)
+
+    async def timing_out(self, sentences, *args, **kwargs):
+        yield 0, sentences[0]
+        raise asyncio.TimeoutError()
+
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f'http://127.0.0.1:{http_server.server_port}/translateTextStream'
+        with pytest.raises(requests.HTTPError):
+            list(client.translate_stream(['this'], url=url, s_lang='en', t_lang='is', model='unknown'))
+        monkeypatch.setattr(api.TranslationEngine, 'translate_stream', timing_out)
+        translations = []
+        with pytest.raises(client.TranslationStreamError):
+            for translation in client.translate_stream(['this', 'that'], url=url, s_lang='en', t_lang='is', model='test'):
+                translations.append(translation)
+    finally:
+        http_server.shutdown()
+        api.shutdown()
+    assert translations == [(0, 'this')]
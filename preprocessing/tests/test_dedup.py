@@ -0,0 +1,27 @@
+import pytest
+
+from preprocessing import dedup
+
+
+@pytest.mark.parametrize('bits', [64, 128])
+def test_fingerprint_set(bits):
+    fingerprints = dedup.FingerprintSet(bits=bits, capacity=4)
+    values = [dedup.fingerprint(str(number), bits) for number in range(1000)]
+    assert all(fingerprints.add(value) for value in values)
+    assert len(fingerprints) == 1000
+    assert not any(fingerprints.add(value) for value in values)
+    assert all(value in fingerprints for value in values)
+    assert dedup.fingerprint('1000', bits) not in fingerprints
+
+
+@pytest.mark.parametrize('mode', dedup.MODES)
+@pytest.mark.parametrize('bits', [64, 128])
+def test_deduplicate(mode, bits, tmp_path):
+    corpus = ['a b\n', 'c\n', 'a b\n', 'A, b!\n', 'c']
+    options = dict(mode=mode, bits=bits, tmp_dir=str(tmp_path), buckets=4)
+    assert [lines[0].rstrip('\n') for lines in dedup.deduplicate([corpus], **options)] == ['a b', 'c', 'A, b!']
+    assert [lines[0].rstrip('\n') for lines in dedup.deduplicate([corpus], normalized=True, **options)] == ['a b', 'c']
+    # Only pairs of lines which are both repeated are removed.
+    other = ['x\n', 'y\n', 'x\n', 'x\n', 'z\n']
+    assert [tuple(line.rstrip('\n') for line in lines) for lines in dedup.deduplicate([corpus, other], **options)] == \
+        [('a b', 'x'), ('c', 'y'), ('A, b!', 'x'), ('c', 'z')]
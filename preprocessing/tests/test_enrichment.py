@@ -0,0 +1,41 @@
+import pytest
+from aiohttp import ClientResponseError
+
+from preprocessing import enrichment
+from preprocessing import pipeline
+
+
+def test_enrich_corpus(enrichment_server, tmp_path):
+    enrichment_server.delay = 0.05
+    corpus = [f'Setning númer {number}\n' for number in range(50)] + ['\n', 'Setning númer 3\n']
+    cache_path = str(tmp_path / 'cache.jsonl')
+    enriched = list(enrichment.enrich_corpus(corpus, url=enrichment_server.url, concurrency=4, chunksize=5, cache_path=cache_path))
+    assert enriched[:50] == [(['Setning', 'númer', str(number)], ['x'] * 3, ['setning', 'númer', str(number)]) for number in range(50)]
+    assert enriched[50] == ([], [], [])
+    assert enriched[51] == enriched[3]
+    assert len(enrichment_server.texts) == 10
+    assert 1 < enrichment_server.max_in_flight <= 4
+
+    # A re-run only sends the new sentences.
+    enriched = list(enrichment.enrich_corpus(corpus + ['Ný setning'], url=enrichment_server.url, chunksize=5, cache_path=cache_path))
+    assert enriched[-1] == (['Ný', 'setning'], ['x', 'x'], ['ný', 'setning'])
+    assert enrichment_server.texts[10:] == ['Ný setning\n']
+
+
+def test_enrich_retries(enrichment_server):
+    enrichment_server.failures = 2
+    assert list(enrichment.enrich_corpus(['Halló'], url=enrichment_server.url, backoff=0.01)) == [(['Halló'], ['x'], ['halló'])]
+    enrichment_server.failures = 2
+    with pytest.raises(ClientResponseError):
+        list(enrichment.enrich_corpus(['Bless'], url=enrichment_server.url, retries=1, backoff=0.01))
+
+
+def test_pipeline_enrich(enrichment_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'URL', enrichment_server.url)
+    cache_path = str(tmp_path / 'cache.jsonl')
+    corpus = ['Halló heimur\n', 'Bless\n', 'Ekki þessi\n']
+    expected = [(['Halló', 'heimur'], ['x', 'x'], ['halló', 'heimur']), (['Bless'], ['x'], ['bless'])]
+    assert list(pipeline.enrich(corpus, lang='is', chunksize=1, lines=2, concurrency=2, cache_path=cache_path)) == expected
+    assert enrichment_server.max_in_flight <= 2
+    assert pipeline.enrich_sentences_is(corpus[:2], cache_path=cache_path) == expected
+    assert len(enrichment_server.texts) == 2
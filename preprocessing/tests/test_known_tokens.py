@@ -0,0 +1,45 @@
+import pickle
+
+import pytest
+
+from preprocessing import known_tokens
+
+
+def test_token_set(tmp_path):
+    path = str(tmp_path / 'tok.is')
+    tokens = ['hús', 'a', 'Hús', 'hús', 'bátur\n', '', 'ö']
+    assert known_tokens.write_token_set(tokens, path) == 5
+    token_set = known_tokens.load_known_tokens(path)
+    assert isinstance(token_set, known_tokens.TokenSet)
+    assert len(token_set) == 5
+    assert set(token_set) == {'a', 'hús', 'Hús', 'bátur', 'ö'}
+    for token in ['a', 'hús', 'Hús', 'bátur', 'ö']:
+        assert token in token_set
+    for token in ['', 'b', 'hú', 'húsa', 'z', 'öö', None]:
+        assert token not in token_set
+    # Only the path is pickled
+    assert len(pickle.dumps(token_set)) < 200
+    assert 'bátur' in pickle.loads(pickle.dumps(token_set))
+
+
+def test_token_set_index(tmp_path):
+    path = str(tmp_path / 'tok.is')
+    # Enough tokens for the index to have collisions.
+    tokens = [f'orð{number}' for number in range(5000)]
+    known_tokens.write_token_set(tokens, path)
+    token_set = known_tokens.TokenSet(path)
+    assert all(token in token_set for token in tokens)
+    assert not any(f'{token}a' in token_set or token[:-1] + 'x' in token_set for token in tokens)
+
+
+def test_old_token_set(tmp_path):
+    path = tmp_path / 'tok.is'
+    path.write_bytes(b'TOKSET01' + bytes(16))
+    with pytest.raises(ValueError, match='rebuild'):
+        known_tokens.load_known_tokens(str(path))
+
+
+def test_load_plain_known_tokens(tmp_path):
+    path = tmp_path / 'tok.is'
+    path.write_text('hús\nbátur\n')
+    assert known_tokens.load_known_tokens(str(path)) == {'hús', 'bátur'}
@@ -0,0 +1,29 @@
+from preprocessing import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = metrics.Counter('sentences_total', 'Sentences.', registry=registry)
+    gauge = metrics.Gauge('in_flight', 'In flight.', registry=registry)
+    histogram = metrics.Histogram('seconds', 'Seconds.', buckets=(0.1, 1.0), registry=registry)
+    counter.inc(3, model='en-is')
+    gauge.inc(model='en-is')
+    gauge.inc(model='en-is')
+    gauge.dec(model='en-is')
+    histogram.observe(0.1, model='en-is')
+    histogram.observe(0.5, model='en-is')
+    histogram.observe(5, model='en-is')
+    assert registry.render() == '''# HELP sentences_total Sentences.
+# TYPE sentences_total counter
+sentences_total{model="en-is"} 3.0
+# HELP in_flight In flight.
+# TYPE in_flight gauge
+in_flight{model="en-is"} 1.0
+# HELP seconds Seconds.
+# TYPE seconds histogram
+seconds_bucket{model="en-is",le="0.1"} 1
+seconds_bucket{model="en-is",le="1.0"} 2
+seconds_bucket{model="en-is",le="+Inf"} 3
+seconds_sum{model="en-is"} 5.6
+seconds_count{model="en-is"} 3
+'''
@@ -1,3 +1,7 @@
+from collections import OrderedDict
+import random
+import threading
+
 from preprocessing import pipeline
 from preprocessing import file_handler
 
@@ -37,6 +41,20 @@ def test_deescape_moses():
     assert result == ['[]<>|']
 
 
+def test_escape_round_trip():
+    rng = random.Random(42)
+    # Escaped underscores are not supported, an "_" next to an escaped character could be read as a placeholder.
+    alphabet = 'ab ð|<>[]pipeltgbc'
+    for _ in range(1000):
+        test = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        escaped = pipeline.escape_line(test)
+        assert not any(char in escaped for char in '|<>[]')
+        assert pipeline.de_escape_line(escaped) == test
+        assert pipeline.de_escape_tokens(pipeline.escape_tokens(test.split(' '))) == test.split(' ')
+    assert pipeline.escape_tokens(['a|b', '[x]']) == ['a_pipe_b', '_bo_x_bc_']
+    assert pipeline.de_escape_line('_lt__gt_pipe_ _bc_') == '<>pipe_ ]'
+
+
 def test_make_batch():
     test = [1, 2, 3]
     batches = []
@@ -49,3 +67,134 @@ def test_make_batch():
         values = list(batch)
         batches.append(values)
     assert batches == [[1, 2], [3]]
+
+
+def test_preprocess_lines(truecase_model):
+    test = ['This is Haukur.', 'THIS is <Haukur>']
+    expected = ['this is Haukur .', 'this is _lt_ Haukur _gt_']
+    assert pipeline.preprocess_lines(test, lang='en', tokenizer=None, truecase_model=truecase_model, known_tokens=None) == expected
+    assert [pipeline.preprocess_line(line, lang='en', tokenizer=None, truecase_model=truecase_model, known_tokens=None)
+            for line in test] == expected
+    for threads in (1, 2):
+        assert list(pipeline.preprocess(test * 3, lang='en', tokenizer=None, truecase_model=truecase_model, known_tokens=None,
+                                        threads=threads, chunksize=2)) == expected * 3
+    # A corpus tokenized once, e.g. for truecase training, gives the same output.
+    tokenized = [' '.join(tokens) + '\n' for tokens in pipeline.tokenize(test, lang='en', tokenizer=None, progress=False)]
+    assert list(pipeline.preprocess(tokenized, lang='en', tokenizer=None, truecase_model=truecase_model, known_tokens=None,
+                                    pretokenized=True)) == expected
+
+
+def test_compound_split_cache(truecase_model, tmp_path, monkeypatch):
+    class Kvistur:
+        calls = 0
+
+        def re_split(self, token):
+            Kvistur.calls += 1
+            return token[:3] + '_' + token[3:]
+
+    monkeypatch.setattr(pipeline, '_lazy_load_kvistur', lambda: Kvistur())
+    monkeypatch.setattr(pipeline, 'lazy_objects', dict())
+    path = str(tmp_path / 'splits.json')
+    test = ['this is Haukur', 'Haukur is this'] * 3
+    expected = ['this is Hau kur', 'Hau kur is this'] * 3
+    assert list(pipeline.preprocess(test, lang='is', tokenizer=None, truecase_model=truecase_model, known_tokens={'this', 'is'},
+                                    use_kvistur=True, kvistur_cache=path)) == expected
+    assert Kvistur.calls == 1
+    assert pipeline.load_split_cache(path).stats() == {'size': 1, 'hits': 5, 'misses': 1, 'hit_rate': 5 / 6}
+
+    # The parent merges the splits of the workers, the workers start warm from the saved cache.
+    monkeypatch.setattr(pipeline, 'lazy_objects', dict())
+    other_path = str(tmp_path / 'other.json')
+    assert list(pipeline.preprocess(test, lang='is', tokenizer=None, truecase_model=truecase_model, known_tokens={'this', 'is'},
+                                    threads=2, chunksize=2, use_kvistur=True, kvistur_cache=other_path)) == expected
+    assert pipeline.load_split_cache(other_path).stats()['size'] == 1
+    cache = pipeline.CompoundSplitCache(path=other_path)
+    cache.load()
+    assert cache.get('Haukur') == 'Hau kur'
+
+    cache = pipeline.CompoundSplitCache(max_size=1)
+    cache.put('a', 'a')
+    cache.put('b', 'b')
+    assert cache.get('a') is None
+    assert cache.get('b') == 'b'
+
+
+def test_compound_split_cache_threads():
+    # Threads of the same process share the cache, e.g. with PROCESSING_EXECUTOR=thread.
+    cache = pipeline.CompoundSplitCache(max_size=2)
+    cache.put('a', 'a')
+    cache.put('b', 'b')
+    threads = []
+
+    class Interleaved(OrderedDict):
+        def get(self, token, default=None):
+            split = super().get(token, default)
+            if token == 'a' and len(threads) == 0:
+                # Another thread evicts the oldest split, "a", in the middle of the lookup unless it waits for the lookup.
+                threads.append(threading.Thread(target=cache.put, args=('c', 'c')))
+                threads[0].start()
+                threads[0].join(0.1)
+            return split
+
+    cache._entries = Interleaved(cache._entries)
+    assert cache.get('a') == 'a'
+    threads[0].join()
+    assert cache.get('b') is None
+    assert cache.get('c') == 'c'
+    delta = cache.delta()
+    assert (delta['hits'], delta['misses']) == (2, 1)
+
+
+def _square_chunk(chunk):
+    return [item * item for item in chunk]
+
+
+def test_parallel_map():
+    read = []
+
+    def items():
+        for item in range(100):
+            read.append(item)
+            yield item
+
+    for threads in (1, 2):
+        read.clear()
+        results = file_handler.parallel_map(_square_chunk, items(), threads=threads, chunksize=3, max_in_flight=2)
+        # The input is read lazily, a bounded number of chunks ahead of the output.
+        assert next(results) == [0, 1, 4]
+        assert len(read) <= 3 * 3
+        assert [item for chunk in results for item in chunk] == [item * item for item in range(3, 100)]
+
+
+_offset = 0
+
+
+def _set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def _add_offset(chunk):
+    return [item + _offset for item in chunk]
+
+
+def test_parallel_map_initializer(truecase_model):
+    # The state set by the initializer is used by every task in the worker.
+    results = file_handler.parallel_map(_add_offset, range(10), threads=2, chunksize=3, initializer=_set_offset, initargs=(100,))
+    assert [item for chunk in results for item in chunk] == list(range(100, 110))
+    assert list(pipeline.preprocess(['This is Haukur.'] * 5, lang='en', tokenizer=None, truecase_model=truecase_model,
+                                    known_tokens={'this'}, threads=2, chunksize=2)) == ['this is Haukur .'] * 5
+
+
+def test_split_lines(tmp_path):
+    path = tmp_path / 'corpus'
+    path.write_text(''.join(f'{number}\n' for number in range(99)) + '99')
+    assert file_handler.count_lines(str(path)) == 100
+    test_lines = pipeline.choose_test_lines(100, test_size=10, seed=1)
+    assert test_lines == pipeline.choose_test_lines(100, test_size=10, seed=1)
+    assert len(test_lines) == 10
+    assert pipeline.choose_test_lines(100, test_size=3, shuffle=False) == {97, 98, 99}
+    with open(str(path)) as corpus:
+        split = list(pipeline.split_lines([corpus, (str(number) for number in range(100))], test_lines))
+    assert [int(lines[1]) for is_test, lines in split if is_test] == sorted(test_lines)
+    assert all(int(lines[0]) == int(lines[1]) for _, lines in split)
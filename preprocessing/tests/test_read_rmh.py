@@ -10,4 +10,44 @@ def test_read_rmh():
     assert len(files) == 666
     corpus = list(file_handler.rmh_2_corpus(files[:2], threads=1, chunksize=1))
     print(corpus)
-    assert len(corpus) == 9
\ No newline at end of file
+    assert len(corpus) == 9
+
+
+TEI_FILE = '''<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+  <teiHeader><p><s><w>Haus</w></s></p></teiHeader>
+  <text><body><div><head><s><w>Fyrirsögn</w></s></head>
+    <p><s><w>Þetta</w><w>er</w><w /><c>.</c></s><s><w>Önnur</w></s></p>
+    <div><p><s><w>Inni</w><c>!</c></s></p></div>
+  </div></body></text>
+</TEI>
+'''
+
+
+def test_iter_rmh_file(tmp_path):
+    small = tmp_path / 'small.xml'
+    small.write_text(TEI_FILE)
+    large = tmp_path / 'large.xml'
+    large.write_text(TEI_FILE.replace('Önnur', 'Stór' * 100))
+    expected = [('Þetta', 'er', '.'), ('Önnur',), ('Inni', '!')]
+    assert list(file_handler.iter_rmh_file(str(small))) == expected
+    # The largest file is read first
+    for threads in (1, 2):
+        corpus = list(file_handler.rmh_2_corpus([str(small), str(large)], threads=threads))
+        assert corpus == [('Þetta', 'er', '.'), ('Stór' * 100,), ('Inni', '!')] + expected
+
+
+def test_iter_rmh_file_memory(tmp_path):
+    import tracemalloc
+
+    def peak_memory(paragraphs: int) -> int:
+        path = tmp_path / f'{paragraphs}.xml'
+        path.write_text(TEI_FILE.replace('<div><p>', '<div>' + '<p><s><w>orð</w><w>annað</w></s></p>' * paragraphs + '<p>'))
+        tracemalloc.start()
+        assert sum(1 for _ in file_handler.iter_rmh_file(str(path))) == paragraphs + 3
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    # The consumed paragraphs are not kept, so the memory used does not grow with the file.
+    assert peak_memory(40000) < 2 * peak_memory(10000)
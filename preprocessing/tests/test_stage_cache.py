@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from preprocessing import stage_cache
+
+
+def test_stage_cache(tmp_path):
+    cache = stage_cache.StageCache(str(tmp_path / 'cache'))
+    corpus, model, output = tmp_path / 'corpus', tmp_path / 'model', tmp_path / 'output'
+    corpus.write_text('a b\n')
+    model.write_text('a (1/1)\n')
+    command = ['preprocess', str(corpus), str(output), 'is', f'--truecase_model={model}']
+    key = cache.key(command, [str(output)])
+    assert cache.restore(key, [str(output)]) is None
+
+    output.write_text('A B\n')
+    cache.store(key, [str(output)], command)
+    os.remove(str(output))
+    assert cache.restore(key, [str(output)])['command'] == command
+    assert output.read_text() == 'A B\n'
+
+    # The key depends on the contents of the inputs and the models, not on the contents or names of the outputs.
+    assert cache.key(command, [str(output)]) == key
+    other_output = tmp_path / 'other_output'
+    assert cache.key([str(other_output) if argument == str(output) else argument for argument in command], [str(other_output)]) == key
+    model.write_text('A (1/1)\n')
+    assert cache.key(command, [str(output)]) != key
+    model.write_text('a (1/1)\n')
+    assert cache.key(command, [str(output)]) == key
+    assert cache.key(command[:-1] + ['--tokenizer', 'moses'], [str(output)]) != key
+    # The number of threads does not change the output.
+    assert cache.key(command + ['--threads', '2', '--resume', '--chunksize=10'], [str(output)]) == key
+    with pytest.raises(ValueError):
+        cache.key(['tokenize', '-', str(output), 'is'], [str(output)])
@@ -0,0 +1,63 @@
+import pytest
+import sacremoses
+from sacremoses import MosesTruecaser
+
+from preprocessing import truecaser
+from preprocessing.truecaser import Truecaser
+
+
+# The outputs of the pinned sacremoses 0.0.38, see requirements.txt. The first line, which starts with an XML tag,
+# raises a NameError in 0.0.38, the output follows the same rules.
+TRUECASED = [
+    ('This is haukur .', 'this is Haukur .'),
+    ('THIS IS ÍSLAND ! this iphone', 'this is Ísland ! this iPhone'),
+    ('  this   is\tunknown Words ', 'this is unknown Words'),
+    ('', ''),
+    ('<b> this </b> is | this|NN haukur|NNP|x <a href="x"> Iphone', '<b> this </b> is | this|NN Haukur|NNP|x <a href="x"> Iphone'),
+    ('a <b this', 'a <b this'),
+    ('x -> y', 'x - > y'),
+    ('a>b this', 'a >b this'),
+    ('hello This is Haukur', 'hello This is Haukur'),
+    ('ok ísland Ísland', 'ok ísland Ísland'),
+    ('ísland . ísland ( This', 'Ísland . Ísland ( This'),
+    ('a : This ? ísland ! Iphone', 'a : this ? Ísland ! iPhone'),
+    ('a . " This', 'a . " This'),
+    ('a .|x This', 'a .|x This'),
+    ('b . <b> This', 'b . <b> this'),
+]
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / 'truecase-model'
+    path.write_text('this (5/6) This (1)\nis (3/3)\nHaukur (2/2)\nÍsland (3/4) ísland (1/4)\niPhone (2/4) Iphone (2/4)\n')
+    return str(path)
+
+
+def test_truecaser(model_path):
+    truecaser = Truecaser(model_path)
+    for line, expected in TRUECASED:
+        assert truecaser.truecase(line) == expected
+    assert truecaser.truecase('THIS is ísland iphone') == 'this is ísland iPhone'
+
+
+@pytest.mark.skipif(sacremoses.__version__ != '0.0.38', reason='Compared to the pinned sacremoses')
+def test_truecaser_matches_sacremoses(model_path):
+    truecaser = Truecaser(model_path)
+    moses = MosesTruecaser(load_from=model_path)
+    # Lines starting with an XML tag raise a NameError in sacremoses 0.0.38.
+    for line, _ in TRUECASED[:4] + TRUECASED[5:]:
+        assert truecaser.truecase(line) == moses.truecase(line, return_str=True)
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_train_matches_sacremoses(threads, tmp_path):
+    corpus = ['The house is red .', 'the House of Haukur !', 'Haukur', '" This is Haukur . The end',
+              'the house <b> is </b> red', 'HOUSE 12 , house'] * 5
+    path = str(tmp_path / 'truecase-model')
+    casing = truecaser.train(corpus, save_to=path, threads=threads, chunksize=4)
+    moses = MosesTruecaser()
+    moses.train([line.split() for line in corpus], possibly_use_first_token=True)
+    assert casing == {lower: dict(forms) for lower, forms in moses.model['casing'].items()}
+    assert truecaser.load_best_casing(path) == moses.model['best']
+    assert truecaser.Truecaser(path).truecase('HAUKUR the house') == moses.truecase('HAUKUR the house', return_str=True)
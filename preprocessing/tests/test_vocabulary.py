@@ -0,0 +1,27 @@
+import io
+
+import pytest
+
+from preprocessing import vocabulary
+from preprocessing import known_tokens
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_count_vocabulary(threads):
+    corpus = ['a b c\n', 'b c\n', 'c  \n', ''] * 3
+    counts = vocabulary.count_vocabulary(corpus, threads=threads, chunksize=2)
+    assert counts == {'a': 3, 'b': 6, 'c': 9}
+    assert vocabulary.sorted_vocabulary(counts) == [('c', 9), ('b', 6), ('a', 3)]
+    assert vocabulary.sorted_vocabulary(counts, min_count=4) == [('c', 9), ('b', 6)]
+    f_out = io.StringIO()
+    vocabulary.write_vocabulary(vocabulary.sorted_vocabulary(counts), f_out)
+    assert list(vocabulary.read_vocabulary(io.StringIO(f_out.getvalue()))) == [('c', 9), ('b', 6), ('a', 3)]
+    assert list(vocabulary.read_vocabulary(['a\n', '\n'])) == [('a', None)]
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_count_unknown_tokens(threads, tmp_path):
+    path = str(tmp_path / 'tok.is')
+    known_tokens.write_token_set(['a', 'b'], path)
+    corpus = ['a b c\n', 'd c\n'] * 3
+    assert vocabulary.count_unknown_tokens(corpus, known_tokens.TokenSet(path), threads=threads, chunksize=1) == {'c': 6, 'd': 3}
@@ -0,0 +1,48 @@
+"""
+Compares the truecasing speed of sacremoses and preprocessing.truecaser on a generated corpus and model.
+The outputs are only compared with the pinned sacremoses 0.0.38, see requirements.txt.
+"""
+import os
+import random
+import tempfile
+from time import time
+
+import sacremoses
+from sacremoses import MosesTruecaser
+
+from preprocessing.truecaser import Truecaser
+
+vocabulary_size = 50000
+lines = 100000
+tokens_per_line = 20
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    letters = 'abcdefghijklmnopqrstuvwxyzáéíóúýþæöð'
+    words = [''.join(rng.choice(letters) for _ in range(rng.randint(2, 12))) for _ in range(vocabulary_size)]
+    with tempfile.NamedTemporaryFile('w', suffix='.truecase-model', delete=False) as f_out:
+        for word in words:
+            f_out.write(f'{word} (3/5) {word.capitalize()} (2)\n')
+        model = f_out.name
+    # Some tokens are capitalized or unknown, like in a real corpus.
+    corpus = [' '.join(rng.choice((str.capitalize, str.upper, str))(rng.choice(words)) if rng.random() < 0.9 else 'unknown'
+                       for _ in range(tokens_per_line)) for _ in range(lines)]
+
+    start = time()
+    moses = MosesTruecaser(load_from=model)
+    print(f'sacremoses load={time() - start:.2f}')
+    start = time()
+    expected = [moses.truecase(line, return_str=True) for line in corpus]
+    moses_took = time() - start
+    print(f'sacremoses truecase={moses_took:.2f}, lines/s={lines / moses_took:.0f}')
+
+    start = time()
+    truecaser = Truecaser(model)
+    print(f'truecaser load={time() - start:.2f}')
+    start = time()
+    result = [truecaser.truecase(line) for line in corpus]
+    took = time() - start
+    print(f'truecaser truecase={took:.2f}, lines/s={lines / took:.0f}, speedup={moses_took / took:.1f}x')
+    if sacremoses.__version__ == '0.0.38':
+        assert result == expected
+    os.remove(model)
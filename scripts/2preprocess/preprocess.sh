@@ -22,20 +22,37 @@ fi
 
 LANG="$1"
 
-function train_truecase() {
-    LANG=$1
-    cat "$OUT_DIR"/train+dict."$LANG" "$FORMATTED_DIR"/mono/data-short."$LANG" | \
-    preprocessing/main.py tokenize - "$OUT_DIR"/truecase-data."$LANG" "$LANG" --threads "$THREADS" --batch_size 5000000 --chunksize 10000
-    # We just use the truecaser from Moses, sacremoses is not good for this.
-    "$MOSESDECODER"/scripts/recaser/train-truecaser.perl --model "$TRUECASE_MODEL"."$LANG" --corpus "$OUT_DIR"/truecase-data."$LANG"
+# Stages which have been run with the same inputs, parameters and code are copied from $STAGE_CACHE_DIR.
+function stage() {
+    OUTPUT=$1
+    shift
+    preprocessing/main.py stage --output "$OUTPUT" -- "$@"
+}
+
+# The training data is tokenized once, the tokens are used to train the truecase model and are then preprocessed.
+function tokenize() {
+    INPUT=$1
+    OUTPUT=$2
+    LANG=$3
+    stage "$OUTPUT" tokenize "$INPUT" "$OUTPUT" "$LANG" --threads "$THREADS" --chunksize 10000 --resume
+}
+
+function preprocess_tokens() {
+    INPUT=$1
+    OUTPUT=$2
+    LANG=$3
+    stage "$OUTPUT" preprocess "$INPUT" "$OUTPUT" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --chunksize 10000 --pretokenized --resume
 }
 
 # Add the dictionary data to the training data
 cat "$FORMATTED_DIR"/parice/train."$LANG" "$FORMATTED_DIR"/dictionary/*."$LANG" > "$OUT_DIR"/train+dict."$LANG"
-train_truecase "$LANG"
-preprocessing/main.py preprocess "$FORMATTED_DIR"/mono/data-short."$LANG" "$OUT_DIR"/mono."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --batch_size 5000000 --chunksize 10000
-preprocessing/main.py preprocess "$OUT_DIR"/train+dict."$LANG" "$TRAINING_DATA"."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --batch_size 5000000 --chunksize 10000
-preprocessing/main.py preprocess "$FORMATTED_DIR"/parice/dev."$LANG" "$DEV_DATA"."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --batch_size 5000000 --chunksize 10000
+tokenize "$OUT_DIR"/train+dict."$LANG" "$OUT_DIR"/train+dict-tok."$LANG" "$LANG"
+tokenize "$FORMATTED_DIR"/mono/data-short."$LANG" "$OUT_DIR"/mono-tok."$LANG" "$LANG"
+cat "$OUT_DIR"/train+dict-tok."$LANG" "$OUT_DIR"/mono-tok."$LANG" > "$OUT_DIR"/truecase-data."$LANG"
+stage "$TRUECASE_MODEL"."$LANG" train-truecase "$OUT_DIR"/truecase-data."$LANG" "$TRUECASE_MODEL"."$LANG" "$LANG" --threads "$THREADS" --chunksize 10000
+preprocess_tokens "$OUT_DIR"/mono-tok."$LANG" "$OUT_DIR"/mono."$LANG" "$LANG"
+preprocess_tokens "$OUT_DIR"/train+dict-tok."$LANG" "$TRAINING_DATA"."$LANG" "$LANG"
+stage "$DEV_DATA"."$LANG" preprocess "$FORMATTED_DIR"/parice/dev."$LANG" "$DEV_DATA"."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --chunksize 10000
 # Data for LM training
 cat "$TRAINING_DATA"."$LANG" "$OUT_DIR"/mono."$LANG" > "$OUT_DIR"/lm-data."$LANG"
 bash scripts/run_in_singularity.sh scripts/2preprocess/lm.sh is "$OUT_DIR"/lm-data."$LANG" "$LM_MODEL"."$LANG" "$LM_ORDER" 
@@ -44,7 +61,7 @@ rm "$TEST_DIR"/combined."$LANG" || true
 rm "$TEST_DIR"/combined-processed."$LANG" || true
 for TEST in $TEST_SETS; do
     cp "$FORMATTED_DIR"/parice/test-"$TEST"."$LANG" "$TEST_DIR"/"$TEST"."$LANG"
-    preprocessing/main.py preprocess "$TEST_DIR"/"$TEST"."$LANG" "$TEST_DIR"/"$TEST"-processed."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --batch_size 5000000 --chunksize 10000
+    stage "$TEST_DIR"/"$TEST"-processed."$LANG" preprocess "$TEST_DIR"/"$TEST"."$LANG" "$TEST_DIR"/"$TEST"-processed."$LANG" "$LANG" --truecase_model "$TRUECASE_MODEL"."$LANG" --threads "$THREADS" --chunksize 10000
     cat "$TEST_DIR"/"$TEST"."$LANG" >> "$TEST_DIR"/combined."$LANG"
     cat "$TEST_DIR"/"$TEST"-processed."$LANG" >> "$TEST_DIR"/combined-processed."$LANG"
 done
\ No newline at end of file
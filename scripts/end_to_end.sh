@@ -30,14 +30,14 @@ if ((FIRST_STEP <= 1 && LAST_STEP >= 1)); then
     scripts/1format/en_mono_format.py "$RAW_DIR"/mono "$FORMATTED_DIR"/mono
     # Remove lines which are too long, tokenize, deduplicate, shorten, detokenize
     sed '/^.\{1024\}./d' <"$FORMATTED_DIR"/mono/data.en | \
-    preprocessing/main.py tokenize - - en --threads "$THREADS" --batch_size 5000000 --chunksize 10000 | \
+    preprocessing/main.py tokenize - - en --threads "$THREADS" --chunksize 10000 | \
     preprocessing/main.py deduplicate - - | \
     shuf | head -n 6578547 | \
     preprocessing/main.py detokenize - "$FORMATTED_DIR"/mono/data-short.en en
 
     # RMH
     # The data is already tokenized so we deduplicate, shorten, detokenize
-    preprocessing/main.py read-rmh "$RAW_DIR"/rmh "$FORMATTED_DIR"/mono/data.is --threads "$THREADS" --chunksize 500
+    preprocessing/main.py read-rmh "$RAW_DIR"/rmh "$FORMATTED_DIR"/mono/data.is --threads "$THREADS" --resume
     preprocessing/main.py deduplicate "$FORMATTED_DIR"/mono/data.is - | \
     shuf | head -n 6578547 | \
     preprocessing/main.py detokenize - "$FORMATTED_DIR"/mono/data-short.is is
@@ -26,6 +26,9 @@ export OUT_DIR="$REPO_DIR"/data/out
 # The location of the actual data and work directory, for volume mapping
 export WORK_DIR=/work/haukurpj
 
+# The cache of preprocessing stages, see "preprocessing/main.py stage"
+export STAGE_CACHE_DIR="$WORK_DIR"/stage-cache
+
 # Truecasing - Where to write the model
 export TRUECASE_MODEL=preprocessing/preprocessing/resources/truecase-model
 